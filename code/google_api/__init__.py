@@ -0,0 +1,51 @@
+import json
+import logging
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+from google.auth.credentials import AnonymousCredentials, Credentials
+from googleapiclient.discovery import Resource, build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+logger = logging.getLogger("django")
+
+
+@lru_cache(maxsize=None)
+def get_discovery_document(api: str, version: str) -> dict:
+    """
+    Load and parse the discovery document of the API once per process.
+
+    The document is looked up in `settings.GOOGLE_DISCOVERY_DOCUMENTS_DIR` (`<api>.<version>.json`),
+    then in the documents shipped with googleapiclient and only then fetched over the network.
+
+    Args:
+        api (str): name of the API, e.g. "calendar"
+        version (str): version of the API, e.g. "v3"
+
+    Returns:
+        dict: parsed discovery document
+    """
+    documents_dir = getattr(settings, "GOOGLE_DISCOVERY_DOCUMENTS_DIR", None)
+    if documents_dir and (path := Path(documents_dir) / f"{api}.{version}.json").exists():
+        return json.loads(path.read_text())
+    if document := get_static_doc(api, version):
+        return json.loads(document)
+    logger.info(f"Discovery document for {api} {version} is not available locally, fetching it")
+    return build(api, version, credentials=AnonymousCredentials(), static_discovery=False)._rootDesc
+
+
+def build_service(api: str, version: str, credentials: Credentials) -> Resource:
+    """
+    Drop-in replacement of `googleapiclient.discovery.build` which reuses the discovery document
+    parsed by the first call in the process and only binds the given credentials.
+
+    Args:
+        api (str): name of the API, e.g. "calendar"
+        version (str): version of the API, e.g. "v3"
+        credentials (Credentials): credentials used by the returned service
+
+    Returns:
+        Resource: service object of the API
+    """
+    return build_from_document(get_discovery_document(api, version), credentials=credentials)
@@ -0,0 +1,69 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import groupby
+
+from django.db import connections
+
+from .google_calendar import GoogleCalendarService
+
+logger = logging.getLogger("django")
+
+MAX_WORKERS = 16
+"number of users synced in parallel"
+CHUNK_SIZE = 2000
+"number of events fetched from the database at once"
+
+
+def _sync_user(user, events: list) -> int:
+    """
+    Sync events of a single user with one service and batched requests.
+
+    Returns:
+        int: number of events which failed
+    """
+    try:
+        return len(GoogleCalendarService(user).sync_events(events))
+    finally:
+        # * Worker threads open their own database connections
+        connections.close_all()
+
+
+def fan_out_events(events, max_workers: int = MAX_WORKERS) -> dict:
+    """
+    Update Google Calendar events of many users, e.g. after a change of `settings.DEFAULT_TIME_FOR_EVENTS`.
+    Events are grouped by user, every user gets a single GoogleCalendarService and its events are sent
+    in batch requests. Users are processed concurrently by a bounded pool, so at most `max_workers`
+    users are held in memory, and an error of one user doesn't stop the others.
+
+    Args:
+        events (QuerySet[CustomScopeQuestion]): events to be created or updated
+        max_workers (int): number of users synced in parallel
+
+    Returns:
+        dict: number of users whose events were all synced, number of failed events
+        and ids of users with failed events or without a service
+    """
+    result = {"users": 0, "failed_events": 0, "failed": []}
+    in_flight = {}
+
+    def collect(done) -> None:
+        for future in done:
+            user_id = in_flight.pop(future)
+            if error := future.exception():
+                logger.error(f"Error syncing calendar of user {user_id}: {error}")
+                result["failed"].append(user_id)
+            elif failed_events := future.result():
+                result["failed_events"] += failed_events
+                result["failed"].append(user_id)
+            else:
+                result["users"] += 1
+
+    rows = events.select_related("user").order_by("user_id").iterator(chunk_size=CHUNK_SIZE)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for user_id, user_events in groupby(rows, key=lambda event: event.user_id):
+            if len(in_flight) >= max_workers:
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+            user_events = list(user_events)
+            in_flight[executor.submit(_sync_user, user_events[0].user, user_events)] = user_id
+        collect(wait(in_flight).done)
+    return result
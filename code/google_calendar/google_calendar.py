@@ -1,41 +1,180 @@
 import calendar
 import logging
-from datetime import timedelta
+import secrets
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, time as dt_time, timedelta, timezone
+from functools import lru_cache
+from itertools import islice
 
 from appness_scope.constants import Frequency
 from appness_scope.models import CustomScopeQuestion
 from authentication.models import User
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import QuerySet
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from google_api import build_service
+from googleapiclient.errors import HttpError
 from social_django.utils import load_strategy
 
+from .models import GoogleCalendarSync
+
 CALENDAR_NAME = "app"
 CALENDAR_SUMMARY = "Contains events from app app"
 WEEK_DURATION = 7
+BATCH_SIZE = 50
+"maximum number of requests in a single batch request of Google Calendar API"
+SOCIAL_AUTH_PROVIDER = "google-oauth2"
+CREDENTIALS_CACHE_KEY = "google-calendar-credentials:{user_id}"
+TOKEN_EXPIRY_MARGIN = 60
+"cached access token is not used if it expires in less than this number of seconds"
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+CALENDAR_EXISTS_CACHE_KEY = "google-calendar-exists:{calendar_id}"
+CALENDAR_EXISTS_TTL = 60 * 60
+"how long in seconds the check that the user's calendar still exists is reused"
+CALENDAR_LOCK_KEY = "google-calendar-resolve:{user_id}"
+LOCK_TIMEOUT = 30
+"maximum time in seconds a calendar resolution holds the lock or waits for it"
+CHANNEL_TTL = 7 * 24 * 60 * 60
+"requested lifetime of watch channels in seconds, Google may shorten it"
 
 logger = logging.getLogger("django")
 
 
+@contextmanager
+def single_flight(key: str, timeout: int = LOCK_TIMEOUT):
+    """
+    Lock shared by all processes through the cache backend. If the lock is not released
+    within `timeout` seconds, the caller proceeds without it.
+    """
+    deadline = time.monotonic() + timeout
+    while not (acquired := cache.add(key, True, timeout=timeout)) and time.monotonic() < deadline:
+        time.sleep(0.2)
+    if not acquired:
+        logger.warning(f"Lock {key} was not released in {timeout}s")
+    try:
+        yield
+    finally:
+        if acquired:
+            cache.delete(key)
+
+
+@lru_cache(maxsize=1024)
+def _weekly_rule(weekday: int, schedule: tuple) -> tuple[int, str]:
+    """
+    Days from the weekday to the first day of the schedule and recurrence rule of the schedule.
+
+    Args:
+        weekday (int): weekday the event was created at
+        schedule (tuple): names of weekdays, e.g. ("MONDAY", "FRIDAY")
+
+    Returns:
+        tuple: number of days and RRULE
+    """
+    # * Here we need to calculate how much days before first calendar week from schedule appear
+    days_difference = sorted((getattr(calendar, day) - weekday + WEEK_DURATION) % WEEK_DURATION for day in schedule)
+    day_list = ",".join([day[:2] for day in schedule])
+    return days_difference[0], f"RRULE:FREQ=WEEKLY;BYDAY={day_list};"
+
+
+def _build_event_data(event: CustomScopeQuestion, tz: str, default_time: dt_time, default_duration: int) -> dict:
+    """Payload of `GoogleCalendarService._prepare_event_data` with settings and timezone resolved by the caller"""
+    event_time = event.event_time or default_time
+    event_start = event.created_at.replace(hour=event_time.hour, minute=event_time.minute, second=event_time.second)
+    recurrence = None
+    if event.frequency == Frequency.DAILY.name:
+        recurrence = "RRULE:FREQ=DAILY;"
+    elif event.frequency == Frequency.MONTHLY.name:
+        # * In case of monthly event we can setup for specific date
+        if event.event_day:
+            event_start = event_start.replace(day=event.event_day)
+        recurrence = "RRULE:FREQ=MONTHLY;"
+    elif event.frequency == Frequency.WEEKLY.name:
+        # * Step event start to first day from schedule
+        days, recurrence = _weekly_rule(event.created_at.weekday(), tuple(event.schedule))
+        event_start = event_start + timedelta(days=days)
+    event_end = event_start + timedelta(minutes=event.score or default_duration)
+    payload = {
+        "summary": event.title,
+        "start": {"dateTime": event_start.strftime(DATETIME_FORMAT), "timeZone": tz},
+        "end": {"dateTime": event_end.strftime(DATETIME_FORMAT), "timeZone": tz},
+    }
+    if recurrence:
+        payload["recurrence"] = [recurrence]
+    return payload
+
+
+class CachedCredentials(Credentials):
+    """Credentials which store the access token refreshed by google-auth in social auth and cache"""
+
+    user_id = None
+
+    def refresh(self, request) -> None:
+        super().refresh(request)
+        if self.user_id is not None:
+            store_access_token(self.user_id, self.token, self.expiry)
+
+
+def store_access_token(user_id: int, token: str, expiry: datetime) -> None:
+    """
+    Write refreshed access token back to social auth extra data and update the cached credentials.
+
+    Args:
+        user_id (int): id of the token owner
+        token (str): new access token
+        expiry (datetime): naive UTC expiry time of the token, as used by google-auth
+    """
+    expires_at = expiry.replace(tzinfo=timezone.utc).timestamp()
+    social = User.objects.get(pk=user_id).social_auth.get(provider=SOCIAL_AUTH_PROVIDER)
+    social.extra_data.update(access_token=token, auth_time=int(time.time()), expires=int(expires_at - time.time()))
+    social.save(update_fields=["extra_data"])
+    cache_access_token(user_id, token, social.extra_data.get("refresh_token"), expires_at)
+
+
+def cache_access_token(user_id: int, token: str, refresh_token: str, expires_at: float) -> None:
+    """Cache the token of the user until it expires"""
+    cache.set(
+        CREDENTIALS_CACHE_KEY.format(user_id=user_id),
+        {"token": token, "refresh_token": refresh_token, "expires_at": expires_at},
+        timeout=max(1, int(expires_at - time.time() - TOKEN_EXPIRY_MARGIN)),
+    )
+
+
 class GoogleCalendarService:
     def __init__(self, user: User) -> None:
         """Create a google calendar service for user with social authorization"""
         self.client_id = settings.SOCIAL_AUTH_GOOGLE_OAUTH2_KEY
         self.client_secret = settings.SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET
         self.user = user
-        social = user.social_auth.get(provider="google-oauth2")
-        token = social.get_access_token(load_strategy())
-        credentials = Credentials.from_authorized_user_info(
-            info={
-                "access_token": token,
-                "refresh_token": social.extra_data.get("refresh_token"),
-                "client_id": self.client_id,
-                "client_secret": self.client_secret,
-            },
-        )
-        self.service = build("calendar", "v3", credentials=credentials)
+        self.service = build_service("calendar", "v3", credentials=self._get_credentials())
         self.calendar_id = self._get_calendar_for_user()
 
+    def _get_credentials(self) -> Credentials:
+        """
+        Return credentials of the user. Access token is taken from the cache while it is valid,
+        otherwise it is read from social auth, which refreshes it when it has expired.
+        """
+        cached = cache.get(CREDENTIALS_CACHE_KEY.format(user_id=self.user.pk))
+        if not cached or cached["expires_at"] - TOKEN_EXPIRY_MARGIN < time.time():
+            social = self.user.social_auth.get(provider=SOCIAL_AUTH_PROVIDER)
+            token = social.get_access_token(load_strategy())
+            expires_at = social.extra_data.get("auth_time", time.time()) + social.extra_data.get("expires", 0)
+            cached = {"token": token, "refresh_token": social.extra_data.get("refresh_token"), "expires_at": expires_at}
+            cache_access_token(self.user.pk, token, cached["refresh_token"], expires_at)
+        credentials = CachedCredentials(
+            token=cached["token"],
+            refresh_token=cached["refresh_token"],
+            token_uri="https://oauth2.googleapis.com/token",
+            client_id=self.client_id,
+            client_secret=self.client_secret,
+            # * google-auth compares expiry with naive UTC time
+            expiry=datetime.fromtimestamp(cached["expires_at"], timezone.utc).replace(tzinfo=None),
+        )
+        credentials.user_id = self.user.pk
+        return credentials
+
     def create_event(self, event: CustomScopeQuestion) -> None:
         """
         Inserts event to google calendar based on CustomScopeQuestion
@@ -51,8 +190,8 @@ class GoogleCalendarService:
             event.save(update_fields=["google_calendar_id"])
         except Exception as error:
             logger.error(f"Error creating event: {error}")
-            event.user.google_calendar_id = None
-            event.user.save(update_fields=["google_calendar_id"])
+            # * Calendar may have been deleted, check it again when the next service is created
+            cache.delete(CALENDAR_EXISTS_CACHE_KEY.format(calendar_id=self.calendar_id))
 
     def delete_event(self, event: CustomScopeQuestion) -> None:
         """
@@ -95,6 +234,195 @@ class GoogleCalendarService:
         except Exception as error:
             logging.error(f"Error updating event: {error}")
 
+    def sync_events(self, events, deleted_events=(), batch_size: int = BATCH_SIZE) -> list:
+        """
+        Creates, updates and deletes events on Google Calendar in batch requests
+        of at most `batch_size` operations. Events without Google Calendar ID are created,
+        the rest are updated. Changed Google Calendar IDs are saved with a single bulk_update.
+
+        Args:
+            events (Iterable[CustomScopeQuestion]): events to be created or updated
+            deleted_events (Iterable[CustomScopeQuestion]): events to be deleted
+            batch_size (int): maximum number of operations in one batch request
+
+        Returns:
+            list: events which operation failed, including all events of a failed batch request
+        """
+        events_api = self.service.events()
+        events = list(events.select_related("user") if isinstance(events, QuerySet) else events)
+        operations = []
+        for event, payload in zip(events, self.prepare_events_data(events), strict=True):
+            if event.google_calendar_id:
+                request = events_api.update(calendarId=self.calendar_id, eventId=event.google_calendar_id, body=payload)
+            else:
+                request = events_api.insert(calendarId=self.calendar_id, body=payload)
+            operations.append((event, request))
+        operations.extend(
+            (event, events_api.delete(calendarId=self.calendar_id, eventId=event.google_calendar_id))
+            for event in deleted_events
+            if event.google_calendar_id
+        )
+        changed, failed = [], []
+        iterator = iter(operations)
+        while chunk := list(islice(iterator, batch_size)):
+            chunk_changed, chunk_failed = self._execute_batch(chunk)
+            changed.extend(chunk_changed)
+            failed.extend(chunk_failed)
+        if changed:
+            CustomScopeQuestion.objects.bulk_update(changed, ["google_calendar_id"])
+        return failed
+
+    def sync_changes(self) -> list:
+        """
+        Fetch events changed on Google Calendar since the previous call using the sync token
+        stored in GoogleCalendarSync. Deleted events lose their Google Calendar ID and renamed
+        events get the new title. The first call and a call with an expired token (410 Gone)
+        fetch all events to get a new sync token.
+
+        [Api docs](https://developers.google.com/calendar/api/guides/sync)
+
+        Returns:
+            list: changed Google Calendar events
+        """
+        state, _ = GoogleCalendarSync.objects.get_or_create(user=self.user, calendar_id=self.calendar_id)
+        try:
+            try:
+                changes, sync_token = self._list_changes(state.sync_token)
+            except HttpError as error:
+                if error.resp.status != 410:
+                    raise
+                logger.info(f"Sync token of user {self.user.pk} expired, running full sync")
+                changes, sync_token = self._list_changes(None)
+        except Exception as error:
+            logger.error(f"Error syncing changes: {error}")
+            return []
+        self._apply_changes(changes)
+        state.sync_token = sync_token
+        state.save(update_fields=["sync_token", "updated_at"])
+        return changes
+
+    def watch_events(self) -> GoogleCalendarSync:
+        """
+        Register a watch channel, so Google notifies `settings.GOOGLE_CALENDAR_NOTIFICATIONS_URL`
+        about changes of the user's calendar. The previous channel of the calendar is stopped
+        once the new one is registered, so no notification is missed in between.
+
+        [Api docs](https://developers.google.com/calendar/api/guides/push)
+
+        Returns:
+            GoogleCalendarSync: state with the new channel
+        """
+        state, _ = GoogleCalendarSync.objects.get_or_create(user=self.user, calendar_id=self.calendar_id)
+        previous_channel_id, previous_resource_id = state.channel_id, state.channel_resource_id
+        try:
+            channel = (
+                self.service.events()
+                .watch(
+                    calendarId=self.calendar_id,
+                    body={
+                        "id": str(uuid.uuid4()),
+                        "type": "web_hook",
+                        "address": settings.GOOGLE_CALENDAR_NOTIFICATIONS_URL,
+                        "token": secrets.token_urlsafe(32),
+                        "params": {"ttl": str(CHANNEL_TTL)},
+                    },
+                )
+                .execute()
+            )
+        except Exception as error:
+            logger.error(f"Error watching calendar: {error}")
+            return state
+        state.channel_id = channel["id"]
+        state.channel_resource_id = channel["resourceId"]
+        state.channel_token = channel["token"]
+        state.channel_expiration = datetime.fromtimestamp(int(channel["expiration"]) / 1000, timezone.utc)
+        state.save(
+            update_fields=["channel_id", "channel_resource_id", "channel_token", "channel_expiration", "updated_at"]
+        )
+        self.stop_watching(previous_channel_id, previous_resource_id)
+        return state
+
+    def stop_watching(self, channel_id: str, resource_id: str) -> None:
+        """Stop the watch channel if there is one"""
+        if not channel_id:
+            return
+        try:
+            self.service.channels().stop(body={"id": channel_id, "resourceId": resource_id}).execute()
+        except Exception as error:
+            logger.error(f"Error stopping channel: {error}")
+
+    def _list_changes(self, sync_token: str | None) -> tuple[list, str]:
+        """
+        List all pages of events changed since the sync token or all events if there is no token.
+
+        Returns:
+            tuple: changed events and the sync token for the next call
+        """
+        changes, page_token = [], None
+        while True:
+            response = (
+                self.service.events()
+                .list(calendarId=self.calendar_id, syncToken=sync_token or None, pageToken=page_token, showDeleted=True)
+                .execute()
+            )
+            changes.extend(response.get("items", []))
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                return changes, response["nextSyncToken"]
+
+    def _apply_changes(self, changes: list) -> None:
+        """Apply deletions and renames made on Google Calendar to CustomScopeQuestion"""
+        changes_by_id = {change["id"]: change for change in changes}
+        changed = []
+        for event in CustomScopeQuestion.objects.filter(user=self.user, google_calendar_id__in=changes_by_id):
+            change = changes_by_id[event.google_calendar_id]
+            if change["status"] == "cancelled":
+                event.google_calendar_id = None
+            elif change.get("summary") and change["summary"] != event.title:
+                event.title = change["summary"]
+            else:
+                continue
+            changed.append(event)
+        if changed:
+            CustomScopeQuestion.objects.bulk_update(changed, ["google_calendar_id", "title"])
+
+    def _execute_batch(self, operations: list) -> tuple[list, list]:
+        """
+        Executes operations in one batch request.
+
+        Args:
+            operations (list): pairs of CustomScopeQuestion and request for it
+
+        Returns:
+            tuple: events which Google Calendar ID has changed and events which operation failed
+        """
+        changed, succeeded = [], set()
+
+        def callback(request_id: str, response: dict, exception: HttpError) -> None:
+            event, request = operations[int(request_id)]
+            is_delete = request.method == "DELETE"
+            if exception is not None and not (is_delete and exception.resp.status in (404, 410)):
+                logger.error(f"Error syncing event {event.pk}: {exception}")
+                return
+            succeeded.add(int(request_id))
+            if is_delete:
+                event.google_calendar_id = None
+                changed.append(event)
+            elif event.google_calendar_id != response["id"]:
+                event.google_calendar_id = response["id"]
+                changed.append(event)
+
+        batch = self.service.new_batch_http_request(callback=callback)
+        for index, (_, request) in enumerate(operations):
+            batch.add(request, request_id=str(index))
+        try:
+            batch.execute()
+        except Exception as error:
+            logger.error(f"Error executing batch request: {error}")
+        # * Operations without successful response failed, also when the whole batch request failed
+        failed = [event for index, (event, _) in enumerate(operations) if index not in succeeded]
+        return changed, failed
+
     @staticmethod
     def _prepare_event_data(event: CustomScopeQuestion) -> dict:
         """Convert our custom action to a Google Calendar event
@@ -103,80 +431,105 @@ class GoogleCalendarService:
 
         [recurrence specs](https://datatracker.ietf.org/doc/html/rfc5545#section-3.8.5)
         """
-        payload = {"summary": event.title}
-        event_time = event.event_time or settings.DEFAULT_TIME_FOR_EVENTS
-        tz = event.user.timezone or "UTC"
-        event_start = event.created_at.replace(hour=event_time.hour, minute=event_time.minute, second=event_time.second)
-        event_duration = event.score or settings.DEFAULT_SCORE
-        payload["start"] = {
-            "dateTime": f"{event_start.strftime('%Y-%m-%dT%H:%M:%S')}",
-            "timeZone": tz,
-        }
-        payload["end"] = {
-            "dateTime": f"{(event_start + timedelta(minutes=event_duration)).strftime('%Y-%m-%dT%H:%M:%S')}",
-            "timeZone": tz,
-        }
-        if event.frequency == Frequency.DAILY.name:
-            payload["recurrence"] = ["RRULE:FREQ=DAILY;"]
-        if event.frequency == Frequency.MONTHLY.name:
-            # * In case of monthly event we can setup for specific date
-            if event.event_day:
-                event_start = event_start.replace(day=event.event_day)
-                payload["start"] = {
-                    "dateTime": f"{event_start.strftime('%Y-%m-%dT%H:%M:%S')}",
-                    "timeZone": tz,
-                }
-                payload["end"] = {
-                    "dateTime": f"{(event_start + timedelta(minutes=event_duration)).strftime('%Y-%m-%dT%H:%M:%S')}",
-                    "timeZone": tz,
-                }
-            payload["recurrence"] = ["RRULE:FREQ=MONTHLY;"]
-        if event.frequency == Frequency.WEEKLY.name:
-            # * Here we need to calculate how much days before first calendar week from schedule appear
-            day = event.created_at.weekday()
-            target_days = [getattr(calendar, item) for item in event.schedule]
-            days_difference = [(target_day - day + WEEK_DURATION) % WEEK_DURATION for target_day in target_days]
-            days_difference.sort()
-            # * Step event start to first day from schedule
-            event_start = event_start + timedelta(days=days_difference[0])
-            payload["start"] = {
-                "dateTime": f"{event_start.strftime('%Y-%m-%dT%H:%M:%S')}",
-                "timeZone": tz,
-            }
-            payload["end"] = {
-                "dateTime": f"{(event_start + timedelta(minutes=event_duration)).strftime('%Y-%m-%dT%H:%M:%S')}",
-                "timeZone": tz,
-            }
-            day_list = ",".join([item[:2] for item in event.schedule])
-            payload["recurrence"] = [f"RRULE:FREQ=WEEKLY;BYDAY={day_list};"]
-        return payload
-
-    def _get_calendar_for_user(self) -> int:
-        """
-        Create a calendar for user in Google Calendar if it doesn't exist already.
+        return _build_event_data(
+            event,
+            tz=event.user.timezone or "UTC",
+            default_time=settings.DEFAULT_TIME_FOR_EVENTS,
+            default_duration=settings.DEFAULT_SCORE,
+        )
+
+    @staticmethod
+    def prepare_events_data(events) -> list:
+        """
+        Batch version of `_prepare_event_data`. Users of querysets are selected in the same query
+        and settings and timezones are resolved once for all events.
+
+        Args:
+            events (QuerySet[CustomScopeQuestion] | Iterable[CustomScopeQuestion]): events to convert
+
+        Returns:
+            list: payloads in the order of events
+        """
+        if isinstance(events, QuerySet):
+            events = events.select_related("user")
+        default_time, default_duration = settings.DEFAULT_TIME_FOR_EVENTS, settings.DEFAULT_SCORE
+        timezones = {}
+        payloads = []
+        for event in events:
+            if event.user_id not in timezones:
+                timezones[event.user_id] = event.user.timezone or "UTC"
+            payloads.append(_build_event_data(event, timezones[event.user_id], default_time, default_duration))
+        return payloads
+
+    def _get_calendar_for_user(self) -> str:
+        """
+        Return id of the user's calendar in Google Calendar. Stored id is used while the calendar
+        exists, the check is cached for CALENDAR_EXISTS_TTL. Otherwise an existing calendar named
+        CALENDAR_NAME is reused or a new one is created. Concurrent resolutions for the same user
+        are serialized, so only one calendar is created.
         Store Google Calendar id in user model and return it.
 
         Returns:
-            int: Google Calendar id
+            str: Google Calendar id
 
         Raises:
             Exception: If there is an error creating calendar
         """
-        if self.user.google_calendar_id:
+        if self.user.google_calendar_id and self._calendar_exists(self.user.google_calendar_id):
             return self.user.google_calendar_id
+        with single_flight(CALENDAR_LOCK_KEY.format(user_id=self.user.pk)):
+            # * Calendar may have been resolved by a concurrent task while we were waiting
+            self.user.refresh_from_db(fields=["google_calendar_id"])
+            calendar_id = self.user.google_calendar_id
+            if calendar_id and self._calendar_exists(calendar_id):
+                return calendar_id
+            try:
+                calendar_id = self._find_calendar() or self._create_calendar()
+            except Exception as error:
+                logging.error(f"Error creating calendar: {error}")
+                return
+            cache.set(CALENDAR_EXISTS_CACHE_KEY.format(calendar_id=calendar_id), True, timeout=CALENDAR_EXISTS_TTL)
+            self.user.google_calendar_id = calendar_id
+            self.user.save(update_fields=["google_calendar_id"])
+            return calendar_id
+
+    def _calendar_exists(self, calendar_id: str) -> bool:
+        """Check that the calendar is in the user's calendar list, positive result is cached"""
+        key = CALENDAR_EXISTS_CACHE_KEY.format(calendar_id=calendar_id)
+        if cache.get(key):
+            return True
         try:
-            calendar = (
-                self.service.calendars()
-                .insert(
-                    body={
-                        "summary": CALENDAR_NAME,
-                        "description": CALENDAR_SUMMARY,
-                    }
-                )
-                .execute()
+            self.service.calendarList().get(calendarId=calendar_id).execute()
+        except HttpError as error:
+            if error.resp.status in (404, 410):
+                return False
+            # * Don't replace the calendar because of a temporary error
+            logger.error(f"Error checking calendar: {error}")
+            return True
+        cache.set(key, True, timeout=CALENDAR_EXISTS_TTL)
+        return True
+
+    def _find_calendar(self) -> str | None:
+        """Return id of an existing calendar owned by the user named CALENDAR_NAME"""
+        calendar_list = self.service.calendarList()
+        request = calendar_list.list(minAccessRole="owner")
+        while request is not None:
+            response = request.execute()
+            for item in response.get("items", []):
+                if item.get("summary") == CALENDAR_NAME:
+                    return item["id"]
+            request = calendar_list.list_next(request, response)
+        return None
+
+    def _create_calendar(self) -> str:
+        calendar = (
+            self.service.calendars()
+            .insert(
+                body={
+                    "summary": CALENDAR_NAME,
+                    "description": CALENDAR_SUMMARY,
+                }
             )
-            self.user.google_calendar_id = calendar["id"]
-            self.user.save(update_fields=["google_calendar_id"])
-            return calendar["id"]
-        except Exception as error:
-            logging.error(f"Error creating calendar: {error}")
+            .execute()
+        )
+        return calendar["id"]
@@ -0,0 +1,38 @@
+from authentication.models import User
+from django.db import models
+
+
+class GoogleCalendarSync(models.Model):
+    """State of incremental synchronization of the user's Google Calendar"""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="google_calendar_syncs")
+    calendar_id = models.CharField(max_length=255)
+    sync_token = models.CharField(max_length=255, blank=True)
+    channel_id = models.CharField(max_length=64, blank=True, db_index=True, help_text="ID of the watch channel")
+    channel_resource_id = models.CharField(max_length=255, blank=True)
+    channel_token = models.CharField(max_length=64, blank=True, help_text="secret sent back with notifications")
+    channel_expiration = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = (models.UniqueConstraint(fields=["user", "calendar_id"], name="unique_user_calendar_sync"),)
+
+    def __str__(self) -> str:
+        return f"{self.user} {self.calendar_id}"
+
+
+class CalendarOutbox(models.Model):
+    """Pending Google Calendar change of CustomScopeQuestion, only the latest change of a question is kept"""
+
+    class Operation(models.TextChoices):
+        UPSERT = "upsert"
+        DELETE = "delete"
+
+    question_id = models.BigIntegerField(unique=True, help_text="CustomScopeQuestion id, the question may be deleted")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="calendar_outbox")
+    operation = models.CharField(max_length=16, choices=Operation.choices)
+    google_calendar_id = models.CharField(max_length=255, blank=True, help_text="event to delete")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f"{self.operation} {self.question_id}"
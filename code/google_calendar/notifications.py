@@ -0,0 +1,77 @@
+import hmac
+import logging
+from collections.abc import Mapping
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.http import HttpRequest, HttpResponse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from .models import GoogleCalendarSync
+
+logger = logging.getLogger("django")
+
+SYNC_DEBOUNCE = 30
+"notifications of a user received within this number of seconds trigger a single sync"
+SYNC_SCHEDULED_KEY = "google-calendar-sync-scheduled:{user_id}"
+CHANNEL_RENEWAL_MARGIN = timedelta(days=1)
+"channels expiring earlier than this are renewed"
+
+
+def schedule_sync(user_id: int) -> bool:
+    """
+    Schedule incremental sync of the user's calendar after SYNC_DEBOUNCE seconds,
+    unless it is already scheduled.
+
+    Returns:
+        bool: whether a new sync was scheduled
+    """
+    from .tasks import sync_calendar_changes
+
+    if not cache.add(SYNC_SCHEDULED_KEY.format(user_id=user_id), True, timeout=SYNC_DEBOUNCE):
+        return False
+    sync_calendar_changes.apply_async(args=[user_id], countdown=SYNC_DEBOUNCE)
+    return True
+
+
+def handle_notification(headers: Mapping, schedule=schedule_sync) -> bool:
+    """
+    Handle push notification of Google Calendar by its headers.
+
+    Args:
+        headers (Mapping): request headers, X-Goog-* headers are used
+        schedule (Callable[[int], bool]): called with id of the user whose calendar changed
+
+    Returns:
+        bool: whether the notification came from a known channel
+    """
+    channel_id, token = headers.get("X-Goog-Channel-ID", ""), headers.get("X-Goog-Channel-Token", "")
+    # * Calendars which are not watched have empty channel id and token, they must not match
+    if not channel_id or not token:
+        return False
+    state = GoogleCalendarSync.objects.filter(channel_id=channel_id).first()
+    if state is None or not hmac.compare_digest(state.channel_token, token):
+        return False
+    # * "sync" is sent once when the channel is created, it doesn't mean any change
+    if headers.get("X-Goog-Resource-State") != "sync":
+        schedule(state.user_id)
+    return True
+
+
+@csrf_exempt
+@require_POST
+def calendar_notifications(request: HttpRequest) -> HttpResponse:
+    """Receives push notifications of Google Calendar watch channels"""
+    if not handle_notification(request.headers):
+        logger.warning(f"Notification from unknown channel {request.headers.get('X-Goog-Channel-ID')}")
+        return HttpResponse(status=404)
+    return HttpResponse(status=200)
+
+
+def channels_to_renew():
+    """GoogleCalendarSync objects which channels expire within CHANNEL_RENEWAL_MARGIN"""
+    return GoogleCalendarSync.objects.exclude(channel_id="").filter(
+        channel_expiration__lt=timezone.now() + CHANNEL_RENEWAL_MARGIN,
+    )
@@ -0,0 +1,129 @@
+import logging
+from functools import reduce
+from itertools import groupby
+from operator import or_
+
+from appness_scope.models import CustomScopeQuestion
+from django.db.models import Q
+from django.utils import timezone
+
+from .google_calendar import GoogleCalendarService
+from .models import CalendarOutbox
+
+logger = logging.getLogger("django")
+
+DRAIN_LIMIT = 5000
+"maximum number of outbox entries processed by a single drain"
+
+
+def enqueue_upsert(event: CustomScopeQuestion) -> None:
+    """
+    Queue creation or update of the event. Repeated changes are coalesced into one entry,
+    whether the event is created or updated is decided when the outbox is drained.
+    """
+    CalendarOutbox.objects.update_or_create(
+        question_id=event.pk,
+        defaults={"user_id": event.user_id, "operation": CalendarOutbox.Operation.UPSERT, "google_calendar_id": ""},
+    )
+
+
+def enqueue_delete(event: CustomScopeQuestion) -> None:
+    """
+    Queue deletion of the event. If the event was never sent to Google Calendar, its pending
+    entry is replaced with a deletion without Google Calendar ID. A drain which reads it sends
+    nothing, a drain which is creating the event at the moment fills in the ID of the created event.
+    """
+    if not event.google_calendar_id:
+        # * update() doesn't set auto_now fields, a drain keeps the entry only if updated_at changed
+        CalendarOutbox.objects.filter(question_id=event.pk).update(
+            operation=CalendarOutbox.Operation.DELETE, google_calendar_id="", updated_at=timezone.now()
+        )
+        return
+    CalendarOutbox.objects.update_or_create(
+        question_id=event.pk,
+        defaults={
+            "user_id": event.user_id,
+            "operation": CalendarOutbox.Operation.DELETE,
+            "google_calendar_id": event.google_calendar_id,
+        },
+    )
+
+
+def _drain_user(user, entries: list) -> tuple[set, dict]:
+    """
+    Send all pending changes of the user in batch requests.
+    Deletions without Google Calendar ID are skipped by `sync_events`, there is nothing to delete.
+
+    Returns:
+        tuple: ids of questions which changes failed and Google Calendar IDs of the sent questions
+    """
+    upserts = [entry.question_id for entry in entries if entry.operation == CalendarOutbox.Operation.UPSERT]
+    deletes = [
+        # * Unsaved instance is enough to delete the event, the question itself may be gone
+        CustomScopeQuestion(pk=entry.question_id, user=user, google_calendar_id=entry.google_calendar_id)
+        for entry in entries
+        if entry.operation == CalendarOutbox.Operation.DELETE
+    ]
+    # * A list, so created events get their Google Calendar IDs set by `sync_events`
+    events = list(CustomScopeQuestion.objects.filter(pk__in=upserts).select_related("user"))
+    failed = {event.pk for event in GoogleCalendarService(user).sync_events(events, deleted_events=deletes)}
+    sent = {
+        event.pk: event.google_calendar_id for event in events if event.pk not in failed and event.google_calendar_id
+    }
+    return failed, sent
+
+
+def _complete_deletions(google_calendar_ids: dict) -> None:
+    """
+    Fill in Google Calendar IDs of questions which were deleted while their creation was being sent,
+    so the next drain deletes the created events instead of leaving them orphaned.
+
+    Args:
+        google_calendar_ids (dict): Google Calendar IDs of the sent questions by question id
+    """
+    entries = list(
+        CalendarOutbox.objects.filter(
+            question_id__in=google_calendar_ids, operation=CalendarOutbox.Operation.DELETE, google_calendar_id=""
+        )
+    )
+    for entry in entries:
+        entry.google_calendar_id = google_calendar_ids[entry.question_id]
+    if entries:
+        CalendarOutbox.objects.bulk_update(entries, ["google_calendar_id"])
+
+
+def drain_outbox(limit: int = DRAIN_LIMIT) -> dict:
+    """
+    Send pending changes to Google Calendar, one service and batched requests per user.
+    Only entries which were sent successfully are removed. Entries which failed, entries of users
+    whose service could not be created and entries changed while they were being sent are kept
+    for the next drain. Questions deleted while being created get the ID of the created event,
+    see `enqueue_delete`.
+
+    Args:
+        limit (int): maximum number of entries processed
+
+    Returns:
+        dict: number of sent entries, number of failed entries and ids of users that failed
+    """
+    result = {"sent": 0, "failed_entries": 0, "failed": []}
+    entries = CalendarOutbox.objects.select_related("user").order_by("user_id", "pk")[:limit]
+    for user_id, user_entries in groupby(entries, key=lambda entry: entry.user_id):
+        user_entries = list(user_entries)
+        try:
+            failed, google_calendar_ids = _drain_user(user_entries[0].user, user_entries)
+        except Exception as error:
+            logger.error(f"Error draining calendar outbox of user {user_id}: {error}")
+            result["failed"].append(user_id)
+            continue
+        if failed:
+            result["failed"].append(user_id)
+            result["failed_entries"] += len(failed)
+        sent = [
+            Q(pk=entry.pk, updated_at=entry.updated_at) for entry in user_entries if entry.question_id not in failed
+        ]
+        if sent:
+            result["sent"] += CalendarOutbox.objects.filter(reduce(or_, sent)).delete()[0]
+        if google_calendar_ids:
+            _complete_deletions(google_calendar_ids)
+    return result
@@ -0,0 +1,54 @@
+import logging
+
+from appness_scope.models import CustomScopeQuestion
+from authentication.models import User
+from celery import shared_task
+from django.core.cache import cache
+
+from .fan_out import fan_out_events
+from .google_calendar import GoogleCalendarService
+from .notifications import SYNC_SCHEDULED_KEY, channels_to_renew
+from .outbox import drain_outbox
+
+celery_logger = logging.getLogger("celery")
+
+
+@shared_task
+def sync_calendar_changes(user_id: int) -> None:
+    """Fetch changes of the user's calendar, triggered by push notifications"""
+    # * Notifications received from now on schedule the next sync
+    cache.delete(SYNC_SCHEDULED_KEY.format(user_id=user_id))
+    GoogleCalendarService(User.objects.get(pk=user_id)).sync_changes()
+
+
+@shared_task
+def renew_calendar_channels() -> None:
+    """Renew watch channels before they expire, should be run periodically"""
+    for state in channels_to_renew().select_related("user"):
+        try:
+            GoogleCalendarService(state.user).watch_events()
+        except Exception as error:
+            celery_logger.error(f"Error renewing channel of user {state.user_id}: {error}")
+
+
+@shared_task
+def sync_default_time_events() -> None:
+    """Update events of all users which use `settings.DEFAULT_TIME_FOR_EVENTS`"""
+    result = fan_out_events(
+        CustomScopeQuestion.objects.filter(event_time__isnull=True, google_calendar_id__isnull=False),
+    )
+    celery_logger.info(
+        f"Synced default time events of {result['users']} users, {len(result['failed'])} users "
+        f"with {result['failed_events']} events failed"
+    )
+
+
+@shared_task
+def drain_calendar_outbox() -> None:
+    """Send pending calendar changes, should be run periodically"""
+    result = drain_outbox()
+    if result["sent"] or result["failed"]:
+        celery_logger.info(
+            f"Sent {result['sent']} calendar changes, {result['failed_entries']} changes "
+            f"and {len(result['failed'])} users failed"
+        )
@@ -0,0 +1,112 @@
+import calendar
+import os
+import random
+import time
+from datetime import datetime, time as dt_time, timedelta
+from types import SimpleNamespace
+from unittest import SkipTest
+
+from appness_scope.constants import Frequency
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+
+from .google_calendar import WEEK_DURATION, GoogleCalendarService
+
+WEEKDAYS = [day.upper() for day in calendar.day_name]
+BENCHMARK_EVENTS = 20000
+"number of events converted by the benchmark"
+
+
+def legacy_prepare_event_data(event) -> dict:
+    """`GoogleCalendarService._prepare_event_data` before it was replaced by `_build_event_data`, kept as the reference"""
+    payload = {"summary": event.title}
+    event_time = event.event_time or settings.DEFAULT_TIME_FOR_EVENTS
+    tz = event.user.timezone or "UTC"
+    event_start = event.created_at.replace(hour=event_time.hour, minute=event_time.minute, second=event_time.second)
+    event_duration = event.score or settings.DEFAULT_SCORE
+    payload["start"] = {
+        "dateTime": f"{event_start.strftime('%Y-%m-%dT%H:%M:%S')}",
+        "timeZone": tz,
+    }
+    payload["end"] = {
+        "dateTime": f"{(event_start + timedelta(minutes=event_duration)).strftime('%Y-%m-%dT%H:%M:%S')}",
+        "timeZone": tz,
+    }
+    if event.frequency == Frequency.DAILY.name:
+        payload["recurrence"] = ["RRULE:FREQ=DAILY;"]
+    if event.frequency == Frequency.MONTHLY.name:
+        if event.event_day:
+            event_start = event_start.replace(day=event.event_day)
+            payload["start"] = {
+                "dateTime": f"{event_start.strftime('%Y-%m-%dT%H:%M:%S')}",
+                "timeZone": tz,
+            }
+            payload["end"] = {
+                "dateTime": f"{(event_start + timedelta(minutes=event_duration)).strftime('%Y-%m-%dT%H:%M:%S')}",
+                "timeZone": tz,
+            }
+        payload["recurrence"] = ["RRULE:FREQ=MONTHLY;"]
+    if event.frequency == Frequency.WEEKLY.name:
+        day = event.created_at.weekday()
+        target_days = [getattr(calendar, item) for item in event.schedule]
+        days_difference = [(target_day - day + WEEK_DURATION) % WEEK_DURATION for target_day in target_days]
+        days_difference.sort()
+        event_start = event_start + timedelta(days=days_difference[0])
+        payload["start"] = {
+            "dateTime": f"{event_start.strftime('%Y-%m-%dT%H:%M:%S')}",
+            "timeZone": tz,
+        }
+        payload["end"] = {
+            "dateTime": f"{(event_start + timedelta(minutes=event_duration)).strftime('%Y-%m-%dT%H:%M:%S')}",
+            "timeZone": tz,
+        }
+        day_list = ",".join([item[:2] for item in event.schedule])
+        payload["recurrence"] = [f"RRULE:FREQ=WEEKLY;BYDAY={day_list};"]
+    return payload
+
+
+def random_events(count: int, seed: int = 0) -> list:
+    """Events with random time, duration, frequency and schedule, sharing a few users"""
+    rng = random.Random(seed)
+    users = [SimpleNamespace(pk=pk, timezone=tz) for pk, tz in enumerate([None, "Europe/London", "America/New_York"])]
+    events = []
+    for index in range(count):
+        user = rng.choice(users)
+        created_at = datetime(2024, 1, 1) + timedelta(minutes=rng.randrange(10**6), microseconds=rng.randrange(10**6))
+        events.append(
+            SimpleNamespace(
+                title=f"Event {index}",
+                user=user,
+                user_id=user.pk,
+                event_time=rng.choice([None, dt_time(rng.randrange(24), rng.randrange(60), rng.randrange(60))]),
+                created_at=created_at,
+                score=rng.choice([None, 0, 30, 90]),
+                frequency=rng.choice([frequency.name for frequency in Frequency]),
+                event_day=rng.choice([None, 1, 15, 28]),
+                schedule=rng.sample(WEEKDAYS, rng.randint(1, len(WEEKDAYS))),
+            )
+        )
+    return events
+
+
+@override_settings(DEFAULT_TIME_FOR_EVENTS=dt_time(9, 30), DEFAULT_SCORE=15)
+class PrepareEventDataTest(SimpleTestCase):
+    def test_matches_legacy_implementation(self):
+        events = random_events(2000)
+        expected = [legacy_prepare_event_data(event) for event in events]
+        self.assertEqual([GoogleCalendarService._prepare_event_data(event) for event in events], expected)
+        self.assertEqual(GoogleCalendarService.prepare_events_data(events), expected)
+
+    def test_benchmark(self):
+        """Compare speed with the legacy implementation, run with GOOGLE_CALENDAR_BENCHMARK=1"""
+        if not os.environ.get("GOOGLE_CALENDAR_BENCHMARK"):
+            raise SkipTest("Set GOOGLE_CALENDAR_BENCHMARK=1 to run the benchmark")
+        events = random_events(BENCHMARK_EVENTS)
+        start = time.perf_counter()
+        for event in events:
+            legacy_prepare_event_data(event)
+        legacy = time.perf_counter() - start
+        start = time.perf_counter()
+        GoogleCalendarService.prepare_events_data(events)
+        batch = time.perf_counter() - start
+        print(f"{BENCHMARK_EVENTS} events: legacy {legacy:.3f}s, batch {batch:.3f}s (speedup {legacy / batch:.1f}x)")
@@ -0,0 +1,111 @@
+import csv
+import gzip
+import os
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+FEED_COLUMNS = (
+    "id",
+    "title",
+    "description",
+    "link",
+    "image_link",
+    "additional_image_link",
+    "material",
+    "condition",
+    "availability",
+    "price",
+    "shipping",
+    "identifier_exists",
+)
+"columns of the feed file, see https://support.google.com/merchants/answer/7052112"
+XML_NAMESPACE = "http://base.google.com/ns/1.0"
+
+
+def _price(price: dict) -> str:
+    return f"{Decimal(price['value'] or 0):.2f} {price['currency']}"
+
+
+def feed_row(product: dict) -> dict:
+    """
+    Convert product data of the Content API (see `GoogleMerchantService.prepare_product_data`)
+    into attributes of a feed file.
+    """
+    return {
+        "id": product["offerId"],
+        "title": product["title"],
+        "description": product["description"],
+        "link": product["link"],
+        "image_link": product["imageLink"],
+        "additional_image_link": ",".join(product["additionalImageLinks"]),
+        "material": product["material"],
+        "condition": product["condition"],
+        "availability": product["availability"].replace("_", " "),
+        "price": _price(product["price"]),
+        "shipping": ",".join(f"{i['country']}:::{_price(i['price'])}" for i in product["shipping"]),
+        "identifier_exists": "yes" if product["identifierExists"] else "no",
+    }
+
+
+def _xml_attributes(product: dict) -> str:
+    """Feed attributes of the product as RSS elements, repeated and nested attributes are expanded"""
+    row = feed_row(product)
+    row.pop("additional_image_link")
+    row.pop("shipping")
+    elements = [f"<g:{key}>{escape(str(value))}</g:{key}>" for key, value in row.items()]
+    elements.extend(
+        f"<g:additional_image_link>{escape(i)}</g:additional_image_link>" for i in product["additionalImageLinks"]
+    )
+    elements.extend(
+        f"<g:shipping><g:country>{i['country']}</g:country><g:price>{_price(i['price'])}</g:price></g:shipping>"
+        for i in product["shipping"]
+    )
+    return "".join(elements)
+
+
+def export_tsv(products, path: str) -> int:
+    """
+    Stream product data into a gzip compressed TSV feed file. The file is written to a temporary
+    path and moved in place at the end, so Merchant Center never fetches a partial feed.
+
+    Args:
+        products (Iterable[dict]): product data as returned by `GoogleMerchantService.prepare_product_data`
+        path (str): destination of the feed file
+
+    Returns:
+        int: number of exported products
+    """
+    count = 0
+    with gzip.open(f"{path}.tmp", "wt", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=FEED_COLUMNS, delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+        for product in products:
+            # * Tabs and new lines are not allowed inside of values
+            writer.writerow({key: " ".join(str(value).split()) for key, value in feed_row(product).items()})
+            count += 1
+    os.replace(f"{path}.tmp", path)
+    return count
+
+
+def export_xml(products, path: str, title: str = "") -> int:
+    """
+    Stream product data into a gzip compressed RSS 2.0 feed file. See `export_tsv`.
+
+    Args:
+        products (Iterable[dict]): product data as returned by `GoogleMerchantService.prepare_product_data`
+        path (str): destination of the feed file
+        title (str): title of the channel
+
+    Returns:
+        int: number of exported products
+    """
+    count = 0
+    with gzip.open(f"{path}.tmp", "wt", encoding="utf-8") as file:
+        file.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<rss version="2.0" xmlns:g="{XML_NAMESPACE}">\n')
+        file.write(f"<channel><title>{escape(title)}</title>\n")
+        for product in products:
+            file.write(f"<item>{_xml_attributes(product)}</item>\n")
+            count += 1
+        file.write("</channel>\n</rss>\n")
+    os.replace(f"{path}.tmp", path)
+    return count
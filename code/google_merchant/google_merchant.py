@@ -1,31 +1,132 @@
+import hashlib
 import json
 import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+from itertools import islice
 
 from django.conf import settings
+from django.db.models import Prefetch, QuerySet
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
 from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+from google_api import build_service
+from googleapiclient.errors import HttpError
 from settings.models import GoogleMerchantConfig
 
+from .feed import export_tsv, export_xml
+from .models import GoogleMerchantProduct
+
 
 logger = logging.getLogger("django")
 
+BATCH_SIZE = 1000
+"maximum number of entries in a single products.custombatch request (API limit is 10000)"
+MAX_BATCH_RETRIES = 3
+"how many times failed batch entries are resent"
+RETRY_DELAY = 2
+"base delay in seconds between retries of failed entries"
+TRANSIENT_CODES = {429, 500, 502, 503, 504}
+"error codes of entries and requests which may succeed when resent"
+TRANSIENT_REASONS = {"quotaExceeded", "rateLimitExceeded", "backendError", "internalError"}
+"error reasons of entries which may succeed when resent"
+PAYLOAD_CHUNK_SIZE = 2000
+"number of items fetched from the database at once when building product data in bulk"
+SHIPPING_REGION = "UK"
+"region of delivery options used as shipping of the product"
+STATUSES_PAGE_SIZE = 250
+"number of product statuses requested per page"
+REFRESH_AFTER = timedelta(days=25)
+"unchanged products are resent after this time, products expire 30 days after the last insert"
+CONTENT_API_SCOPES = ["https://www.googleapis.com/auth/content"]
+CONFIG_CACHE_TTL = 300
+"how long in seconds the config and credentials are reused before reading them from the database again"
+
+SYNC_MODE_API = "api"
+"push products with the Content API"
+SYNC_MODE_FEED = "feed"
+"export products to a feed file fetched by Merchant Center on schedule"
+
+_config_cache = {}
+_config_lock = threading.Lock()
+
+
+def _chunked(iterable, size: int):
+    """Yield lists of at most ``size`` elements from ``iterable`` without materializing it"""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def get_merchant_config() -> tuple[GoogleMerchantConfig, Credentials]:
+    """
+    Return GoogleMerchantConfig and service account credentials cached for CONFIG_CACHE_TTL seconds.
+    Credentials keep their access token, so it is reused until it expires instead of minting a new one
+    for every service instance.
+    """
+    with _config_lock:
+        if _config_cache.get("expires_at", 0) < time.monotonic():
+            config = GoogleMerchantConfig.objects.first()
+            _config_cache.update(
+                config=config,
+                # * Scoped credentials are used by the service as is, so the access token is shared
+                credentials=Credentials.from_service_account_info(
+                    json.loads(json.dumps(config.account)),
+                    scopes=CONTENT_API_SCOPES,
+                ),
+                expires_at=time.monotonic() + CONFIG_CACHE_TTL,
+            )
+        return _config_cache["config"], _config_cache["credentials"]
+
+
+def invalidate_merchant_config(**kwargs) -> None:
+    """
+    Drop cached config and credentials. Connected to GoogleMerchantConfig signals, so changes
+    are picked up immediately in the current process and after CONFIG_CACHE_TTL in the others.
+    """
+    with _config_lock:
+        _config_cache.clear()
+
+
+post_save.connect(invalidate_merchant_config, sender=GoogleMerchantConfig, dispatch_uid="invalidate_merchant_config")
+post_delete.connect(invalidate_merchant_config, sender=GoogleMerchantConfig, dispatch_uid="invalidate_merchant_config")
+
+
+def is_transient_error(errors: dict) -> bool:
+    """
+    Check whether the failed entry may succeed when resent.
+
+    Args:
+        errors (dict): errors of the entry as returned by `GoogleMerchantService.execute_batch`
+
+    Returns:
+        bool: True for quota and backend errors and for requests that failed without a response
+    """
+    if errors.get("code") is None or errors["code"] in TRANSIENT_CODES:
+        return True
+    return any(error.get("reason") in TRANSIENT_REASONS for error in errors.get("errors", []))
+
+
+def request_errors(error: Exception) -> dict:
+    """Errors of a whole failed request in the format of entry errors"""
+    return {"code": error.resp.status if isinstance(error, HttpError) else None, "message": str(error)}
+
 
 class GoogleMerchantService:
     def __init__(self) -> None:
         """
         Initializes an instance of the class with a GoogleMerchantConfig object,
         from which it extracts account credentials to authenticate with the Google Content API.
+        Both are cached between instances, see `get_merchant_config`.
         Instantiates an object of the Google Content API service to use in the class.
         """
 
-        self.config = GoogleMerchantConfig.objects.first()
+        self.config, credentials = get_merchant_config()
         self.merchant_id = self.config.merchant_id
         self.feed_id = self.config.feed_id
-        self.service = build(
-            "content",
-            "v2.1",
-            credentials=Credentials.from_service_account_info(json.loads(json.dumps(self.config.account))),
-        )
+        self.service = build_service("content", "v2.1", credentials=credentials)
 
     def upload_item_to_google_merchant(self, item) -> None:
         """
@@ -39,15 +140,43 @@ class GoogleMerchantService:
         Args:
             item (Item): The item to be uploaded to the Google Merchant Centre
         """
+        product_data = self.prepare_product_data(item)
+        try:
+            self.service.products().insert(
+                merchantId=self.merchant_id, body=product_data
+            ).execute()
+        except Exception as error:
+            logging.error(f"Error adding item: {error}")
+
+    def delete_item_from_google_merchant(self, item) -> None:
+        try:
+            self.service.products().delete(merchantId=self.merchant_id, productId=self.product_id(item.ref)).execute()
+        except Exception as error:
+            logging.error(f"Error deleting item: {error}")
+
+    @staticmethod
+    def prepare_product_data(item) -> dict:
+        """
+        Convert the given item into a product resource of the Content API v2.1.
+
+        Args:
+            item (Item): The item to be converted
+
+        Returns:
+            dict: product data ready to be sent to the Google Merchant Centre
+        """
         country_map = {"EU": "EU", "USA": "USA", "UK": "GB", "WORLD": "001"}
+        # * Filter in python, so delivery options prefetched by `iter_product_data` are reused
         shipping = [
             {
                 "country": country_map[i.region],
                 "price": {"value": i.price or 0, "currency": str(item.currency)},
             }
-            for i in item.delivery_options.filter(region="UK")
+            for i in item.delivery_options.all()
+            if i.region == SHIPPING_REGION
         ]
-        product_data = {
+        materials = item.item_materials()
+        return {
             "offerId": item.ref,
             "channel": "online",  # indicates the item is sold through the online store
             "title": item.title,
@@ -56,7 +185,7 @@ class GoogleMerchantService:
             "link": f"{settings.SITE_URL}{item.sf_url}",
             "imageLink": item.image(),
             "additionalImageLinks": [i.image.url for i in item.images.all()],
-            "material": item.item_materials()[0] if item.item_materials() else "",
+            "material": materials[0] if materials else "",
             "contentLanguage": "en",
             "targetCountry": "GB",
             "condition": "used",  # condition of the item, i.e. new, used, refurbished
@@ -64,39 +193,294 @@ class GoogleMerchantService:
             "shipping": shipping,  # list of shipping options for the item
             "price": {"value": item.price, "currency": str(item.currency)},
         }
-        try:
-            self.service.products().insert(
-                merchantId=self.merchant_id, body=product_data
-            ).execute()
-        except Exception as error:
-            logging.error(f"Error adding item: {error}")
 
-    def delete_item_from_google_merchant(self, item) -> None:
-        try:
-            self.service.products().delete(merchantId=self.merchant_id, productId=f"online:en:GB:{item.ref}").execute()
-        except Exception as error:
-            logging.error(f"Error deleting item: {error}")
+    def iter_product_data(self, items, chunk_size: int = PAYLOAD_CHUNK_SIZE):
+        """
+        Yield product data for every item. Querysets are fetched in chunks of `chunk_size` with
+        delivery options, images and materials prefetched, so the number of queries depends on the
+        number of chunks and not on the number of items.
+
+        Args:
+            items (QuerySet[Item] | Iterable[Item]): items to be converted
+            chunk_size (int): number of items fetched from the database at once
+
+        Yields:
+            dict: product data as returned by `prepare_product_data`
+        """
+        if isinstance(items, QuerySet):
+            delivery_option_model = items.model._meta.get_field("delivery_options").related_model
+            # * `image()` and `item_materials()` read the prefetched `images` and `materials`
+            items = items.prefetch_related(
+                Prefetch("delivery_options", queryset=delivery_option_model.objects.filter(region=SHIPPING_REGION)),
+                "images",
+                "materials",
+            ).iterator(chunk_size=chunk_size)
+        for item in items:
+            yield self.prepare_product_data(item)
+
+    @staticmethod
+    def product_id(offer_id: str) -> str:
+        """REST id of the product in the Google Merchant Centre for the given offer id"""
+        return f"online:en:GB:{offer_id}"
+
+    def sync_items(self, items, deleted_items=(), batch_size: int = BATCH_SIZE) -> dict:
+        """
+        Uploads and deletes items in the Google Merchant Centre in bulk via products.custombatch.
+
+        Args:
+            items (Iterable[Item]): items to be inserted or updated
+            deleted_items (Iterable[Item]): items to be removed
+            batch_size (int): maximum number of entries sent in one request
 
-    def get_statistics(self) -> dict:
+        Returns:
+            dict: see `sync_products`
+        """
+        return self.sync_products(
+            self.iter_product_data(items),
+            (item.ref for item in deleted_items),
+            batch_size=batch_size,
+        )
+
+    def sync_products(self, products, deleted_offer_ids=(), batch_size: int = BATCH_SIZE) -> dict:
+        """
+        Sends insert entries for the given product data and delete entries for the given offer ids
+        in products.custombatch requests of at most `batch_size` entries.
+        Entries that failed with a transient error (see `is_transient_error`) are resent up to
+        MAX_BATCH_RETRIES times, other failures are reported without retrying.
+
+        Args:
+            products (Iterable[dict]): product data as returned by `prepare_product_data`
+            deleted_offer_ids (Iterable[str]): offer ids of products to be removed
+            batch_size (int): maximum number of entries sent in one request
+
+        Returns:
+            dict: number of inserted and deleted products and a list of failed entries,
+            each with its offer id, method and the errors returned by the Content API.
+        """
+        entries = self.batch_entries(products, deleted_offer_ids)
+        result = {"inserted": 0, "deleted": 0, "failed": []}
+        for chunk in _chunked(entries, batch_size):
+            pending = dict(enumerate(chunk))
+            for attempt in range(MAX_BATCH_RETRIES + 1):
+                if attempt:
+                    time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+                try:
+                    errors = self.execute_batch(pending)
+                except Exception as error:
+                    # * Whole request failed, so every entry has the error of the request
+                    errors = dict.fromkeys(pending, request_errors(error))
+                pending = self.collect_batch_result(result, pending, errors)
+                result["failed"].extend(self.batch_failures(self.pop_permanent_failures(pending, errors), errors))
+                if not pending:
+                    break
+            result["failed"].extend(self.batch_failures(pending, errors))
+        self.log_failures(result)
+        return result
+
+    @staticmethod
+    def collect_batch_result(result: dict, entries: dict, errors: dict) -> dict:
+        """
+        Count entries that were synced successfully into `result`.
+
+        Returns:
+            dict: failed entries keyed by batch id
+        """
+        for batch_id in entries.keys() - errors.keys():
+            result["inserted" if entries[batch_id]["method"] == "insert" else "deleted"] += 1
+        return {batch_id: entries[batch_id] for batch_id in errors}
+
+    @staticmethod
+    def pop_permanent_failures(entries: dict, errors: dict) -> dict:
+        """Remove failed entries which should not be resent from `entries` and return them"""
+        permanent = [batch_id for batch_id in entries if not is_transient_error(errors[batch_id])]
+        return {batch_id: entries.pop(batch_id) for batch_id in permanent}
+
+    @staticmethod
+    def batch_failures(entries: dict, errors: dict) -> list:
+        """Failed entries in the format of `sync_products` result"""
+        return [
+            {"offerId": entry["offerId"], "method": entry["method"], "errors": errors[batch_id]}
+            for batch_id, entry in entries.items()
+        ]
+
+    @staticmethod
+    def log_failures(result: dict) -> None:
+        for failure in result["failed"]:
+            logger.error(f"Error syncing item {failure['offerId']} ({failure['method']}): {failure['errors']}")
+
+    def sync_catalogue(self, items, mode: str | None = None) -> dict:
+        """
+        Sync the whole catalogue either by pushing changed items with the Content API
+        or by exporting all items to the feed file.
+
+        Mode defaults to `settings.GOOGLE_MERCHANT_SYNC_MODE`, the feed file path is taken from
+        `settings.GOOGLE_MERCHANT_FEED_PATH`, its extension (.tsv.gz or .xml.gz) selects the format.
+
+        Args:
+            items (QuerySet[Item] | Iterable[Item]): the whole catalogue
+            mode (str): SYNC_MODE_API or SYNC_MODE_FEED
+
+        Returns:
+            dict: result of `sync_changed_items` or number of exported items
+        """
+        mode = mode or getattr(settings, "GOOGLE_MERCHANT_SYNC_MODE", SYNC_MODE_API)
+        if mode == SYNC_MODE_API:
+            return self.sync_changed_items(items)
+        if mode == SYNC_MODE_FEED:
+            path = settings.GOOGLE_MERCHANT_FEED_PATH
+            export = export_xml if path.endswith(".xml.gz") else export_tsv
+            return {"exported": export(self.iter_product_data(items), path)}
+        raise ValueError(f"Unknown sync mode: {mode}")
+
+    def sync_changed_items(self, items, batch_size: int = BATCH_SIZE) -> dict:
+        """
+        Incremental version of `sync_items`. Only items whose product data changed since the last
+        sync or which were last sent more than REFRESH_AFTER ago are uploaded, and products that
+        are no longer present in `items` are deleted.
+        Hashes of the sent product data are stored in GoogleMerchantProduct, entries that failed
+        are not stored, so they are picked up by the next sync.
+
+        Args:
+            items (Iterable[Item]): the whole catalogue that should be present in the Google Merchant Centre
+            batch_size (int): maximum number of entries sent in one request
+
+        Returns:
+            dict: see `sync_products`
+        """
+        known_hashes = dict(GoogleMerchantProduct.objects.values_list("offer_id", "content_hash"))
+        # * Products expire in Merchant Center unless they are inserted again
+        expiring = set(
+            GoogleMerchantProduct.objects.filter(updated_at__lt=timezone.now() - REFRESH_AFTER).values_list(
+                "offer_id", flat=True
+            )
+        )
+        seen, changed_hashes = set(), {}
+
+        def changed_products():
+            for product in self.iter_product_data(items):
+                content_hash = self.product_hash(product)
+                seen.add(product["offerId"])
+                if known_hashes.get(product["offerId"]) != content_hash or product["offerId"] in expiring:
+                    changed_hashes[product["offerId"]] = content_hash
+                    yield product
+
+        # * Deletes are sent after all inserts, so `seen` is complete by the time this is consumed
+        deleted_offer_ids = (offer_id for offer_id in known_hashes if offer_id not in seen)
+        result = self.sync_products(changed_products(), deleted_offer_ids, batch_size=batch_size)
+
+        failed = {failure["offerId"] for failure in result["failed"]}
+        GoogleMerchantProduct.objects.bulk_create(
+            [
+                GoogleMerchantProduct(offer_id=offer_id, content_hash=content_hash)
+                for offer_id, content_hash in changed_hashes.items()
+                if offer_id not in failed
+            ],
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=["offer_id"],
+            update_fields=["content_hash", "updated_at"],
+        )
+        GoogleMerchantProduct.objects.filter(
+            offer_id__in=known_hashes.keys() - seen - failed,
+        ).delete()
+        return result
+
+    @staticmethod
+    def product_hash(product_data: dict) -> str:
+        """Stable hash of the product data, independent of the keys order"""
+        serialized = json.dumps(product_data, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    @classmethod
+    def batch_entries(cls, products, deleted_offer_ids):
+        """Yield custombatch entries: inserts first, then deletes. `offerId` is kept for error reporting"""
+        for product in products:
+            yield {"offerId": product["offerId"], "method": "insert", "product": product}
+        for offer_id in deleted_offer_ids:
+            yield {"offerId": offer_id, "method": "delete", "productId": cls.product_id(offer_id)}
+
+    def execute_batch(self, entries: dict) -> dict:
+        """
+        Send the given entries in one products.custombatch request.
+
+        Args:
+            entries (dict): entries keyed by batch id
+
+        Returns:
+            dict: errors keyed by batch id of every entry that failed, each with the error `code`,
+            `message` and the list of `errors` with their reasons. Deletes of missing products succeed.
+
+        Raises:
+            HttpError: If the whole request failed
+        """
+        body = {
+            "entries": [
+                {"batchId": batch_id, "merchantId": self.merchant_id, "method": entry["method"]}
+                | {key: value for key, value in entry.items() if key in ("product", "productId")}
+                for batch_id, entry in entries.items()
+            ]
+        }
+        response = self.service.products().custombatch(body=body).execute()
+        return {
+            entry["batchId"]: entry["errors"]
+            for entry in response.get("entries", [])
+            # * Deleting a product which doesn't exist anymore is done
+            if entry.get("errors")
+            and not (entries[entry["batchId"]]["method"] == "delete" and entry["errors"].get("code") == 404)
+        }
+
+    def get_statistics(self, max_results: int = STATUSES_PAGE_SIZE, include_issues: bool = False) -> dict:
         """
         Get statistics about the items in the Google Merchant Centre.
+        Statuses are streamed page by page and counted on the fly, so memory usage does not depend
+        on the number of items in the account.
+
+        Args:
+            max_results (int): number of product statuses requested per page (API limit is 250)
+            include_issues (bool): whether to add the histogram of item level issues
 
         Returns:
             dict: dictionary containing information about the items in the Google Merchant Centre,
             including the total number of items, the number of items that have been disapproved,
-            and the number of available items.
+            and the number of available items, with breakdowns by destination and by country.
+            If `include_issues` is set, it also contains the number of items per issue code.
         """
+        all_items = disapproved = 0
+        destinations = defaultdict(Counter)
+        countries = defaultdict(Counter)
+        issues = Counter()
         try:
-            statuses = self.service.productstatuses().list(
-                merchantId=self.merchant_id,
-            ).execute().get("resources")
-            all_items = len(statuses)
-            disapproved = len([i for i in statuses if i["destinationStatuses"][0]["status"] == "disapproved"])
-            available = all_items - disapproved
-            return {
-                "all": all_items,
-                "disapproved": disapproved,
-                "available": available,
-            }
+            for status in self._iter_product_statuses(max_results):
+                all_items += 1
+                destination_statuses = status.get("destinationStatuses", [])
+                if destination_statuses and destination_statuses[0]["status"] == "disapproved":
+                    disapproved += 1
+                for destination in destination_statuses:
+                    destinations[destination["destination"]][destination["status"]] += 1
+                    for state in ("approved", "pending", "disapproved"):
+                        for country in destination.get(f"{state}Countries", []):
+                            countries[country][state] += 1
+                if include_issues:
+                    issues.update({issue["code"] for issue in status.get("itemLevelIssues", [])})
         except Exception as error:
             logging.error("Error getting statistics: %s", error)
+            return
+        statistics = {
+            "all": all_items,
+            "disapproved": disapproved,
+            "available": all_items - disapproved,
+            "destinations": {destination: dict(counter) for destination, counter in destinations.items()},
+            "countries": {country: dict(counter) for country, counter in countries.items()},
+        }
+        if include_issues:
+            statistics["issues"] = dict(issues.most_common())
+        return statistics
+
+    def _iter_product_statuses(self, max_results: int):
+        """Yield product statuses of the account following `nextPageToken` until the last page"""
+        statuses = self.service.productstatuses()
+        request = statuses.list(merchantId=self.merchant_id, maxResults=max_results)
+        while request is not None:
+            response = request.execute()
+            yield from response.get("resources", [])
+            request = statuses.list_next(request, response)
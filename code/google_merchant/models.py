@@ -0,0 +1,12 @@
+from django.db import models
+
+
+class GoogleMerchantProduct(models.Model):
+    """State of the product as it was last sent to the Google Merchant Centre"""
+
+    offer_id = models.CharField(max_length=50, primary_key=True)
+    content_hash = models.CharField(max_length=64, help_text="sha256 of the last sent product data")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return self.offer_id
@@ -0,0 +1,180 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.db import connections
+from googleapiclient.errors import HttpError
+
+from .google_merchant import BATCH_SIZE, MAX_BATCH_RETRIES, GoogleMerchantService, _chunked, request_errors
+
+logger = logging.getLogger("django")
+
+MAX_IN_FLIGHT = 8
+"maximum number of custombatch requests executed at the same time"
+REQUESTS_PER_SECOND = 5
+"sustained rate of Content API requests, keep it below the per-minute quota of the account"
+MIN_REQUESTS_PER_SECOND = 0.2
+"rate is never lowered below this value when quota errors occur"
+MAX_BACKOFF = 64
+"maximum delay in seconds between retries of a failed request"
+SLOW_DOWN_COOLDOWN = 10
+"seconds after lowering the rate during which further quota errors don't lower it again"
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket rate limiter with adaptive rate.
+
+    The rate is halved on quota errors and slowly restored on successful requests (AIMD).
+    Requests in flight during a quota spike all fail together, so the rate is lowered
+    at most once per `cooldown` seconds.
+    """
+
+    def __init__(
+        self, rate: float = REQUESTS_PER_SECOND, capacity: int | None = None, cooldown: float = SLOW_DOWN_COOLDOWN
+    ) -> None:
+        self.max_rate = self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self.tokens = self.capacity
+        self.cooldown = cooldown
+        self.updated_at = time.monotonic()
+        self.slowed_at = None
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a token is available and take it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def slow_down(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            if self.slowed_at is not None and now - self.slowed_at < self.cooldown:
+                return
+            self.slowed_at = now
+            self.rate = max(MIN_REQUESTS_PER_SECOND, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+        logger.warning(f"Content API quota exceeded, rate lowered to {self.rate:.2f} requests per second")
+
+    def speed_up(self) -> None:
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+def _is_quota_error(errors) -> bool:
+    """Check errors of the request or of a batch entry for quotaExceeded reason"""
+    return "quotaExceeded" in str(errors)
+
+
+def _backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(MAX_BACKOFF, 2**attempt))
+
+
+class ConcurrentMerchantUploader:
+    """
+    Sends products.custombatch requests of GoogleMerchantService concurrently from a thread pool,
+    keeping at most `max_in_flight` requests running and the request rate under the quota.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        requests_per_second: float = REQUESTS_PER_SECOND,
+        batch_size: int = BATCH_SIZE,
+    ) -> None:
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.limiter = TokenBucket(requests_per_second)
+        # * Google API clients are not thread safe, so every worker thread gets its own service
+        self._local = threading.local()
+
+    @property
+    def service(self) -> GoogleMerchantService:
+        if not hasattr(self._local, "service"):
+            self._local.service = GoogleMerchantService()
+        return self._local.service
+
+    def sync_items(self, items, deleted_items=()) -> dict:
+        """Concurrent version of `GoogleMerchantService.sync_items`"""
+        return self.sync_products(self.service.iter_product_data(items), (item.ref for item in deleted_items))
+
+    def sync_products(self, products, deleted_offer_ids=()) -> dict:
+        """
+        Concurrent version of `GoogleMerchantService.sync_products`.
+        Entries are read lazily, only `max_in_flight` chunks are held in memory at once.
+
+        Returns:
+            dict: see `GoogleMerchantService.sync_products`
+        """
+        result = {"inserted": 0, "deleted": 0, "failed": []}
+        chunks = _chunked(GoogleMerchantService.batch_entries(products, deleted_offer_ids), self.batch_size)
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            for chunk in chunks:
+                if len(in_flight) >= self.max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    self._merge(result, done)
+                in_flight.add(executor.submit(self._sync_chunk, chunk))
+            self._merge(result, wait(in_flight).done)
+        GoogleMerchantService.log_failures(result)
+        return result
+
+    @staticmethod
+    def _merge(result: dict, futures) -> None:
+        for future in futures:
+            chunk_result = future.result()
+            result["inserted"] += chunk_result["inserted"]
+            result["deleted"] += chunk_result["deleted"]
+            result["failed"].extend(chunk_result["failed"])
+
+    def _sync_chunk(self, chunk: list) -> dict:
+        """
+        Send one chunk of entries, retrying entries that failed with transient errors, including
+        failures of the whole request, up to MAX_BATCH_RETRIES times with exponential backoff.
+        """
+        result = {"inserted": 0, "deleted": 0, "failed": []}
+        pending, errors = dict(enumerate(chunk)), {}
+        attempt = 0
+        try:
+            while pending and attempt <= MAX_BATCH_RETRIES:
+                if attempt:
+                    time.sleep(_backoff(attempt))
+                self.limiter.acquire()
+                try:
+                    errors = self.service.execute_batch(pending)
+                except Exception as error:
+                    # * Whole request failed, so every entry has the error of the request. Like in
+                    # * `GoogleMerchantService.sync_products` 429/5xx and errors without response
+                    # * (timeouts, connection resets) are resent, others fail the entries
+                    errors = dict.fromkeys(pending, request_errors(error))
+                    if isinstance(error, HttpError) and (error.resp.status == 429 or _is_quota_error(error.content)):
+                        self.limiter.slow_down()
+                else:
+                    if any(_is_quota_error(entry_errors) for entry_errors in errors.values()):
+                        self.limiter.slow_down()
+                    else:
+                        self.limiter.speed_up()
+                pending = GoogleMerchantService.collect_batch_result(result, pending, errors)
+                result["failed"].extend(
+                    GoogleMerchantService.batch_failures(
+                        GoogleMerchantService.pop_permanent_failures(pending, errors), errors
+                    )
+                )
+                attempt += 1
+        finally:
+            # * Worker threads open their own database connections (see `service`), Django closes
+            # * connections only for request threads
+            connections.close_all()
+        result["failed"].extend(GoogleMerchantService.batch_failures(pending, errors))
+        return result
@@ -1,12 +1,18 @@
+import atexit
 import logging
 import os
 import random
+import threading
 import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from pathlib import Path
 
 import undetected_chromedriver as uc
+from celery.signals import worker_process_shutdown
 from django.conf import settings
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.remote.webelement import WebElement
 
 ROOT_DIR = Path(__file__).resolve(strict=True).parent.parent.parent.parent
@@ -22,6 +28,10 @@ RENDER_TIMEOUT = 20
 "timeout for rendering wait"
 CAPTCHA_TIMEOUT = 110
 "maximum time to solve captcha via extension"
+POOL_MAX_USES = 50
+"number of messages sent by a pooled driver before it is recycled"
+POOL_IDLE_TIMEOUT = 600
+"pooled drivers unused for this number of seconds are closed"
 
 
 def fill_input(input_element: WebElement, value: str, clear=False, delay=MAX_INPUT_DELAY) -> None:
@@ -50,8 +60,141 @@ def interaction_timeout() -> float:
     return random.uniform(0, MAX_INTERACTION_DELAY)
 
 
+@dataclass
+class PooledDriver:
+    "Browser kept alive between messages with its login state"
+
+    driver: uc.Chrome
+    uses: int = 0
+    logged_in: bool = False
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class DriverPool:
+    """Warm browsers keyed by (site, profile), so a profile starts Chrome and logs in once
+    for many messages. Drivers are recycled after errors, after `max_uses` messages
+    and when they are idle for `idle_timeout` seconds, which is checked by a background thread
+    """
+
+    def __init__(self, max_uses: int = POOL_MAX_USES, idle_timeout: float = POOL_IDLE_TIMEOUT) -> None:
+        self.max_uses = max_uses
+        self.idle_timeout = idle_timeout
+        self.idle: dict[tuple, list[PooledDriver]] = {}
+        self.lock = threading.Lock()
+        self.reaper: threading.Thread | None = None
+
+    @staticmethod
+    def is_healthy(driver: uc.Chrome) -> bool:
+        "Check that the browser is still running and responds"
+        try:
+            return bool(driver.window_handles)
+        except WebDriverException:
+            return False
+
+    @staticmethod
+    def reset(driver: uc.Chrome) -> None:
+        "Close windows left open by the previous message and switch to the first one"
+        handles = driver.window_handles
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+
+    @staticmethod
+    def quit(pooled: PooledDriver) -> None:
+        try:
+            pooled.driver.quit()
+        except Exception as error:
+            logger.info(f"Error closing driver: {error}")
+
+    def evict_idle(self) -> None:
+        "Close drivers which were not used for `idle_timeout` seconds"
+        deadline = time.monotonic() - self.idle_timeout
+        with self.lock:
+            expired = [pooled for drivers in self.idle.values() for pooled in drivers if pooled.last_used < deadline]
+            for key in list(self.idle):
+                self.idle[key] = [pooled for pooled in self.idle[key] if pooled.last_used >= deadline]
+                if not self.idle[key]:
+                    del self.idle[key]
+        for pooled in expired:
+            self.quit(pooled)
+
+    def _reap(self) -> None:
+        while True:
+            time.sleep(self.idle_timeout / 2)
+            self.evict_idle()
+
+    def _start_reaper(self) -> None:
+        "Start the thread closing idle drivers, so they don't wait for the next `acquire`"
+        with self.lock:
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self._reap, name="driver-pool-reaper", daemon=True)
+                self.reaper.start()
+
+    def acquire(self, key: tuple, factory) -> PooledDriver:
+        "Take a healthy idle driver for the key or start a new one with `factory`"
+        self.evict_idle()
+        while True:
+            with self.lock:
+                pooled = self.idle.get(key, []).pop() if self.idle.get(key) else None
+            if pooled is None:
+                return PooledDriver(driver=factory())
+            if self.is_healthy(pooled.driver):
+                try:
+                    self.reset(pooled.driver)
+                    return pooled
+                except WebDriverException as error:
+                    logger.info(f"Error resetting driver: {error}")
+            self.quit(pooled)
+
+    def release(self, key: tuple, pooled: PooledDriver, healthy: bool = True) -> None:
+        "Return the driver to the pool or close it if it failed or reached `max_uses`"
+        pooled.uses += 1
+        pooled.last_used = time.monotonic()
+        if not healthy or pooled.uses >= self.max_uses:
+            self.quit(pooled)
+            return
+        with self.lock:
+            self.idle.setdefault(key, []).append(pooled)
+        self._start_reaper()
+
+    @contextmanager
+    def borrow(self, key: tuple, factory):
+        "Context manager version of acquire and release, drivers are recycled after any error"
+        pooled = self.acquire(key, factory)
+        try:
+            yield pooled
+        except BaseException:
+            self.release(key, pooled, healthy=False)
+            raise
+        self.release(key, pooled)
+
+    def close_all(self) -> None:
+        "Close all idle drivers, called when the process exits"
+        with self.lock:
+            drivers = [pooled for drivers in self.idle.values() for pooled in drivers]
+            self.idle.clear()
+        for pooled in drivers:
+            self.quit(pooled)
+
+
+driver_pool = DriverPool()
+"process wide pool used by MessagePoster.run"
+atexit.register(driver_pool.close_all)
+
+
+@worker_process_shutdown.connect
+def close_driver_pool(**kwargs) -> None:
+    "Celery pool processes exit without running atexit handlers"
+    driver_pool.close_all()
+
+
 class MessagePoster(ABC):
     def initialize_driver(self) -> None:
+        self.driver = self.create_driver()
+
+    @staticmethod
+    def create_driver() -> uc.Chrome:
         opt = uc.ChromeOptions()
         opt.headless = False
         prefs = {
@@ -77,10 +220,11 @@ class MessagePoster(ABC):
         driver.get(f"https://nopecha.com/setup#{NOPECHA_KEY}")
         """
         opt.add_argument(f"--load-extension={os.path.join(ROOT_DIR, 'extensions', 'NopeCHA-CAPTCHA-Solver')}")
-        self.driver = uc.Chrome(options=opt)
+        driver = uc.Chrome(options=opt)
         # For elements to be clickable
-        self.driver.maximize_window()
-        self.driver.get(f'https://nopecha.com/setup#{os.environ.get("NOPECHA_KEY")}')
+        driver.maximize_window()
+        driver.get(f'https://nopecha.com/setup#{os.environ.get("NOPECHA_KEY")}')
+        return driver
 
     @abstractmethod
     def login(self) -> None:
@@ -98,16 +242,34 @@ class MessagePoster(ABC):
     def send_post(self) -> None:
         raise NotImplementedError
 
+    @property
+    def pool_key(self) -> tuple:
+        "Drivers are shared by messages of the same site and profile"
+        return (type(self).__name__, self.profile.pk)
+
     def run(
         self,
         dry_run: bool = False,
+        pooled: bool = True,
     ) -> None:
         "Run the message poster to send submit form"
-        self.initialize_driver()
-        self.login()
+        if not pooled:
+            self.initialize_driver()
+            self.login()
+            self.post(dry_run)
+            self.close()
+            return
+        with driver_pool.borrow(self.pool_key, self.create_driver) as session:
+            self.driver = session.driver
+            if not session.logged_in:
+                self.login()
+                session.logged_in = True
+            self.post(dry_run)
+
+    def post(self, dry_run: bool = False) -> None:
+        "Fill and submit form of the listing with logged in driver"
         self.navigate()
         self.fill_input_form()
         if not dry_run:
             self.send_post()
         self.driver.save_screenshot(f"{settings.MEDIA_ROOT}/{self.listing}.png")
-        self.close()
@@ -80,16 +80,23 @@ class Website1MessagePoster(MessagePoster):
             self.driver.quit()
             raise LoginError(f"Account {self.profile.email} Cannot enter profile page")
 
+    def set_nopecha_enabled(self, enabled: bool) -> None:
+        "Set state of NopeCHA extension in the current tab, pooled drivers keep it between messages"
+        self.driver.get("chrome://extensions/")
+        extensions = self.driver.find_element(By.CSS_SELECTOR, "extensions-manager")
+        toggle = (
+            extensions.shadow_root.find_element(By.ID, "viewManager")
+            .find_element(By.ID, "items-list")
+            .shadow_root.find_element(By.CSS_SELECTOR, "extensions-item")
+            .shadow_root.find_element(By.ID, "enableToggle")
+        )
+        if (toggle.get_attribute("checked") == "true") != enabled:
+            toggle.click()
+
     def navigate(self) -> None:
         "Navigate to the specified URL and handle 404/expired links"
         # Disabling Nopecha after first verification
-        self.driver.get("chrome://extensions/")
-        extensions = self.driver.find_element(By.CSS_SELECTOR, "extensions-manager")
-        extensions.shadow_root.find_element(By.ID, "viewManager").find_element(
-            By.ID, "items-list"
-        ).shadow_root.find_element(By.CSS_SELECTOR, "extensions-item").shadow_root.find_element(
-            By.ID, "enableToggle"
-        ).click()
+        self.set_nopecha_enabled(False)
         url = f"https://www.website1.co.uk/property-for-sale/contactBranch.html?propertyId={self.listing}"
         self.driver.get(url)
         try:
@@ -261,14 +268,9 @@ class Website1MessagePoster(MessagePoster):
         "Send the post message on website1 and pass captcha"
         # Enable NopeCha before submitting
         self.driver.switch_to.new_window(WindowTypes.TAB)
-        self.driver.get("chrome://extensions/")
-        extensions = self.driver.find_element(By.CSS_SELECTOR, "extensions-manager")
-        extensions.shadow_root.find_element(By.ID, "viewManager").find_element(
-            By.ID, "items-list"
-        ).shadow_root.find_element(By.CSS_SELECTOR, "extensions-item").shadow_root.find_element(
-            By.ID, "enableToggle"
-        ).click()
-        # Switch back to form submission
+        self.set_nopecha_enabled(True)
+        # Close the extensions tab and switch back to form submission
+        self.driver.close()
         self.driver.switch_to.window(self.driver.window_handles[0])
         self.driver.find_element(By.CSS_SELECTOR, 'button[data-test="submitButton"]').click()
         # Wait for captcha to be solved if present
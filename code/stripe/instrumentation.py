@@ -0,0 +1,94 @@
+import logging
+import re
+import threading
+import time
+from functools import wraps
+from urllib.parse import urlsplit
+
+import stripe
+
+try:
+    from prometheus_client import Counter, Histogram
+except ImportError:  # * Metrics are exported only if prometheus_client is installed
+    Counter = Histogram = None
+
+django_logger = logging.getLogger("django")
+
+SLOW_CALL_THRESHOLD = 1.0
+"Stripe requests slower than this number of seconds are logged as warnings"
+OBJECT_ID_PATTERN = re.compile(r"/[a-z]+_(?=[a-z]*[A-Z0-9])[A-Za-z0-9]+")
+"Stripe object IDs in request paths, replaced to keep the number of endpoints low"
+
+if Histogram is not None:
+    REQUEST_LATENCY = Histogram(
+        "stripe_request_duration_seconds",
+        "Latency of Stripe requests including retries",
+        ["method", "endpoint", "outcome"],
+    )
+    REQUEST_RETRIES = Counter(
+        "stripe_request_retries_total",
+        "Number of retried Stripe requests",
+        ["method", "endpoint"],
+    )
+
+_local = threading.local()
+
+
+def instrumented(func):
+    """Marks Stripe requests made inside of the function with its name"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, "method", None)
+        _local.method = func.__qualname__
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.method = previous
+
+    return wrapper
+
+
+def record_call(method: str, endpoint: str, latency: float, retries: int, outcome: str) -> None:
+    """Exports timing of a Stripe request to Prometheus and structured logs"""
+    if Histogram is not None:
+        REQUEST_LATENCY.labels(method, endpoint, outcome).observe(latency)
+        if retries:
+            REQUEST_RETRIES.labels(method, endpoint).inc(retries)
+    data = {
+        "method": method,
+        "endpoint": endpoint,
+        "latency": round(latency, 3),
+        "retries": retries,
+        "outcome": outcome,
+    }
+    if latency > SLOW_CALL_THRESHOLD:
+        django_logger.warning(f"Slow Stripe request {endpoint} in {method}: {latency:.3f}s", extra={"stripe": data})
+    else:
+        django_logger.debug(f"Stripe request {endpoint} in {method}: {latency:.3f}s", extra={"stripe": data})
+
+
+class InstrumentedRequestsClient(stripe.RequestsClient):
+    """RequestsClient which records latency, retries and outcome of every Stripe request"""
+
+    def request_with_retries(self, method, url, *args, **kwargs):
+        endpoint = f"{method.upper()} {OBJECT_ID_PATTERN.sub('/{id}', urlsplit(url).path)}"
+        _local.attempts = 0
+        outcome = "error"
+        start = time.perf_counter()
+        try:
+            response = super().request_with_retries(method, url, *args, **kwargs)
+            outcome = str(response[1])
+            return response
+        finally:
+            record_call(
+                getattr(_local, "method", None) or "unknown",
+                endpoint,
+                time.perf_counter() - start,
+                max(0, _local.attempts - 1),
+                outcome,
+            )
+
+    def request(self, *args, **kwargs):
+        _local.attempts = getattr(_local, "attempts", 0) + 1
+        return super().request(*args, **kwargs)
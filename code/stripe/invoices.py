@@ -0,0 +1,103 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+from django.db import connections
+
+from .models import StripeInvoice
+from .stripe import BULK_CONCURRENCY, RateLimiter, configure_stripe
+
+celery_logger = logging.getLogger("celery")
+
+PAGE_SIZE = 100
+"maximum page size of Stripe list requests"
+TRANSIENT_ERRORS = (stripe.error.APIConnectionError, stripe.error.APIError, stripe.error.RateLimitError)
+"errors left after Stripe network retries which may pass on the next run"
+
+
+def _finalized_state(invoice: stripe.Invoice) -> str:
+    return StripeInvoice.State.PAID if invoice["status"] == "paid" else StripeInvoice.State.FINALIZED
+
+
+def _failed_state(state: str | None, error: Exception) -> str:
+    """Only drafts which Stripe refused to finalize fail, other invoices keep their progress
+    to be resumed by the next run. Finalized invoices are not listed as drafts anymore,
+    so their failed payment is retried only this way
+    """
+    if state in (StripeInvoice.State.FINALIZED, StripeInvoice.State.PAID):
+        return state
+    if isinstance(error, stripe.error.StripeError) and not isinstance(error, TRANSIENT_ERRORS):
+        return StripeInvoice.State.FAILED
+    return StripeInvoice.State.FINALIZING
+
+
+def _process_invoice(invoice_id: str, state: str | None, limiter: RateLimiter) -> str:
+    """Finalizes and pays the invoice, skipping steps which were done by a previous run
+
+    :param invoice_id: Stripe invoice ID
+    :param state: state of the invoice saved by a previous run
+    :param limiter: limiter shared by all workers
+    :return: new state of the invoice
+    """
+    try:
+        if state == StripeInvoice.State.FINALIZING:
+            # * The previous run could stop after finalizing the invoice but before saving the new state
+            limiter.wait()
+            invoice = stripe.Invoice.retrieve(invoice_id)
+            if invoice["status"] != "draft":
+                state = _finalized_state(invoice)
+                StripeInvoice.objects.filter(id=invoice_id).update(state=state)
+        if state not in (StripeInvoice.State.FINALIZED, StripeInvoice.State.PAID):
+            StripeInvoice.objects.update_or_create(
+                id=invoice_id, defaults={"state": StripeInvoice.State.FINALIZING, "error": ""}
+            )
+            limiter.wait()
+            invoice = stripe.Invoice.finalize_invoice(invoice_id, idempotency_key=f"finalize-{invoice_id}")
+            state = _finalized_state(invoice)
+            StripeInvoice.objects.filter(id=invoice_id).update(state=state)
+        if state == StripeInvoice.State.FINALIZED:
+            limiter.wait()
+            stripe.Invoice.pay(invoice_id, idempotency_key=f"pay-{invoice_id}")
+            state = StripeInvoice.State.PAID
+            StripeInvoice.objects.filter(id=invoice_id).update(state=state)
+    except Exception as e:
+        celery_logger.error(f"Error processing invoice {invoice_id}: {e}")
+        state = _failed_state(state, e)
+        try:
+            StripeInvoice.objects.update_or_create(id=invoice_id, defaults={"state": state, "error": str(e)})
+        except Exception as db_error:
+            celery_logger.error(f"Error saving state of invoice {invoice_id}: {db_error}")
+    finally:
+        # * Worker threads open their own database connections
+        connections.close_all()
+    return state
+
+
+def process_draft_invoices(concurrency: int = BULK_CONCURRENCY) -> dict:
+    """Finalizes and pays all draft invoices with bounded concurrency.
+    Progress of every invoice is stored in StripeInvoice, so a crashed run can be started again:
+    invoices finalized but not paid by the previous run are paid without finalizing them again,
+    invoices the previous run stopped finalizing are checked on Stripe first.
+    Errors are recorded per invoice and don't stop the run, see `_failed_state`
+
+    :param concurrency: number of invoices processed in parallel
+    :return: number of invoices per resulting state, duration and throughput
+    """
+    configure_stripe()
+    start = time.monotonic()
+    # * Collect IDs before processing, finalized invoices leave the draft list while it is paginated
+    drafts = [invoice["id"] for invoice in stripe.Invoice.list(status="draft", limit=PAGE_SIZE).auto_paging_iter()]
+    # * Invoices left finalizing are not drafts anymore if Stripe finalized them before the run stopped
+    unpaid = StripeInvoice.objects.filter(
+        state__in=[StripeInvoice.State.FINALIZING, StripeInvoice.State.FINALIZED]
+    ).values_list("id", "state")
+    states = dict.fromkeys(drafts) | dict(unpaid)
+    limiter = RateLimiter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda item: _process_invoice(*item, limiter), states.items()))
+    duration = time.monotonic() - start
+    report = {state.value: results.count(state) for state in StripeInvoice.State}
+    report |= {"duration": round(duration, 1), "per_second": round(len(results) / duration, 1) if duration else 0}
+    celery_logger.info(f"Processed {len(results)} draft invoices: {report}")
+    return report
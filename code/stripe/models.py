@@ -0,0 +1,39 @@
+from django.db import models
+
+
+class StripeEvent(models.Model):
+    """Processed Stripe webhook event, used to skip redelivered and outdated events"""
+
+    id = models.CharField(max_length=255, primary_key=True, help_text="Stripe event ID")
+    type = models.CharField(max_length=255)
+    object_id = models.CharField(
+        max_length=255,
+        blank=True,
+        help_text="Type and Stripe ID of the object which state the event changes, e.g. subscription:sub_123",
+    )
+    created = models.DateTimeField(help_text="Time the event was created on Stripe")
+    processed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = (models.Index(fields=["object_id", "created"]),)
+
+    def __str__(self) -> str:
+        return f"{self.type} {self.id}"
+
+
+class StripeInvoice(models.Model):
+    """Progress of a draft invoice in `process_draft_invoices`, so an interrupted run can be resumed"""
+
+    class State(models.TextChoices):
+        FINALIZING = "finalizing"
+        FINALIZED = "finalized"
+        PAID = "paid"
+        FAILED = "failed"
+
+    id = models.CharField(max_length=255, primary_key=True, help_text="Stripe invoice ID")
+    state = models.CharField(max_length=16, choices=State.choices)
+    error = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f"{self.id} {self.state}"
@@ -0,0 +1,94 @@
+import logging
+from datetime import datetime
+from itertools import islice
+
+import stripe
+from app.models import AppPlan, AppSubscription
+
+from .stripe import configure_stripe
+from .webhooks import subscription_fields, subscription_price
+
+celery_logger = logging.getLogger("celery")
+
+PAGE_SIZE = 100
+"maximum page size of Stripe list requests"
+CHUNK_SIZE = 1000
+"number of subscriptions compared with the database at once"
+TERMINAL_STATUSES = {"canceled", "incomplete_expired"}
+"statuses of Stripe subscriptions which never become active again"
+
+
+def _is_same(local, remote) -> bool:
+    """Compares field values, datetimes are compared by timestamp to ignore timezone awareness"""
+    if isinstance(local, datetime) and isinstance(remote, datetime):
+        return local.timestamp() == remote.timestamp()
+    return local == remote
+
+
+def _chunked(iterable, size: int):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def reconcile_subscriptions(apply: bool = False, chunk_size: int = CHUNK_SIZE) -> dict:
+    """Finds drift between Stripe subscriptions and AppSubscription.
+    Subscriptions are streamed from Stripe by pages of PAGE_SIZE and compared with the database in
+    chunks, so the whole pass takes one Stripe request per page and a few queries per chunk
+
+    :param apply: save values from Stripe to outdated AppSubscription objects with bulk_update
+    :param chunk_size: number of subscriptions compared with the database at once
+    :return: report with number of checked subscriptions, list of differences,
+        Stripe subscription IDs which are missing in the database and number of ended subscriptions
+        without AppSubscription, which are not reported as missing
+    """
+    configure_stripe()
+    report = {"checked": 0, "differences": [], "missing": [], "ended": 0, "updated": 0}
+    plans = {plan.price_token: plan for plan in AppPlan.objects.all()}
+    subscriptions = stripe.Subscription.list(limit=PAGE_SIZE, status="all").auto_paging_iter()
+    for chunk in _chunked(subscriptions, chunk_size):
+        local = {
+            app_subscription.subscription_id: app_subscription
+            for app_subscription in AppSubscription.objects.filter(subscription_id__in=[s["id"] for s in chunk])
+        }
+        changed, changed_fields = [], set()
+        for subscription in chunk:
+            report["checked"] += 1
+            app_subscription = local.get(subscription["id"])
+            if app_subscription is None:
+                # * Ended subscriptions are listed to reconcile AppSubscription which is still active,
+                # * they are not expected to exist in the database
+                if subscription["status"] in TERMINAL_STATUSES:
+                    report["ended"] += 1
+                else:
+                    report["missing"].append(subscription["id"])
+                continue
+            fields = subscription_fields(subscription)
+            if plan := plans.get(subscription_price(subscription)):
+                fields["plan_id"] = plan.pk
+            differences = {
+                field: value for field, value in fields.items() if not _is_same(getattr(app_subscription, field), value)
+            }
+            if not differences:
+                continue
+            report["differences"].extend(
+                {
+                    "subscription_id": subscription["id"],
+                    "field": field,
+                    "local": getattr(app_subscription, field),
+                    "remote": value,
+                }
+                for field, value in differences.items()
+            )
+            for field, value in differences.items():
+                setattr(app_subscription, field, value)
+            changed.append(app_subscription)
+            changed_fields.update(differences)
+        if apply and changed:
+            AppSubscription.objects.bulk_update(changed, fields=sorted(changed_fields))
+            report["updated"] += len(changed)
+    celery_logger.info(
+        f"Reconciled {report['checked']} subscriptions: {len(report['differences'])} differences, "
+        f"{len(report['missing'])} missing, {report['ended']} ended, {report['updated']} updated"
+    )
+    return report
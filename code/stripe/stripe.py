@@ -1,14 +1,85 @@
 import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+from functools import cache
 
+import requests
 import stripe
 from authentication.models import User
 from app.models import AppPlan, AppSubscription
 from django.conf import settings
+from django.db import connections
+from requests.adapters import HTTPAdapter
+
+from .instrumentation import InstrumentedRequestsClient, instrumented
 
 celery_logger = logging.getLogger("celery")
 django_logger = logging.getLogger("django")
 
+BULK_CONCURRENCY = 8
+"default number of users processed in parallel by bulk operations"
+REQUESTS_PER_SECOND = 20
+"rate of Stripe requests of bulk operations, Stripe allows 25/s in test mode and 100/s in live mode"
+RATE_LIMIT_RETRIES = 5
+"how many times a user is retried after stripe.error.RateLimitError"
+SUBSCRIPTION_EXPAND = ["default_payment_method", "customer.invoice_settings.default_payment_method"]
+"expand subscription responses with payment methods, so the card doesn't need extra requests"
+CUSTOMER_EXPAND = ["invoice_settings.default_payment_method"]
+"expand customer responses with the default payment method"
+MAX_NETWORK_RETRIES = 2
+"retries of failed Stripe requests, POST requests get idempotency keys automatically"
+REQUEST_TIMEOUT = 30
+"timeout of Stripe requests in seconds"
+CONNECTION_POOL_SIZE = 20
+"number of keep-alive connections to Stripe, should be at least BULK_CONCURRENCY"
+
+
+@cache
+def configure_stripe() -> None:
+    """Configures stripe module once per process: API key, retries, timeout and an HTTP client
+    with pooled keep-alive connections shared by all threads, so TLS handshakes are not repeated.
+    The client records timing of every request, see `instrumentation`
+    """
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=CONNECTION_POOL_SIZE))
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+    stripe.max_network_retries = MAX_NETWORK_RETRIES
+    stripe.default_http_client = InstrumentedRequestsClient(timeout=REQUEST_TIMEOUT, session=session)
+
+
+class RateLimiter:
+    """Thread safe limiter which spreads requests evenly at `rate` requests per second"""
+
+    def __init__(self, rate: float = REQUESTS_PER_SECOND) -> None:
+        self.interval = 1 / rate
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self, requests: int = 1) -> None:
+        """Block until `requests` more requests may be sent"""
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0.0, self.next_at - now)
+            self.next_at = max(now, self.next_at) + self.interval * requests
+        time.sleep(delay)
+
+
+@dataclass
+class BulkResult:
+    """Result of a bulk operation for a single user"""
+
+    user: User
+    subscription: AppSubscription | None = None
+    error: str = ""
+
+    @property
+    def ok(self) -> bool:
+        return self.subscription is not None
+
 
 class StripeSubscriptionService:
     """Use this service to work with stripe subscription system"""
@@ -21,8 +92,26 @@ class StripeSubscriptionService:
 
         self.user: User = user
         self.plan: AppPlan = plan
-        stripe.api_key = settings.STRIPE_SECRET_KEY
+        configure_stripe()
+
+    @staticmethod
+    def card_last4(obj: stripe.StripeObject) -> str:
+        """Returns last 4 digits of the default card of subscription or customer
+        requested with SUBSCRIPTION_EXPAND or CUSTOMER_EXPAND
+
+        :param obj: Stripe subscription or customer
+        :return: last 4 digits of the card or empty string if there is no card
+        """
+        # * Stripe objects are not dicts, missing keys are checked with `in` and expanded objects by type
+        payment_method = obj["default_payment_method"] if "default_payment_method" in obj else None
+        customer = obj if obj["object"] == "customer" else obj["customer"] if "customer" in obj else None
+        if not payment_method and isinstance(customer, stripe.StripeObject):
+            payment_method = customer["invoice_settings"]["default_payment_method"]
+        if isinstance(payment_method, stripe.StripeObject) and "card" in payment_method and payment_method["card"]:
+            return payment_method["card"]["last4"]
+        return ""
 
+    @instrumented
     def update_or_create_customer(self, payment_method: str) -> User:
         """Creates customer for stripe if does not exist for current user
         else returns existed stripe customer for current user
@@ -47,13 +136,14 @@ class StripeSubscriptionService:
             # * Attach payment method to stripe customer
             try:
                 pm = stripe.PaymentMethod.attach(payment_method, customer=self.user.stripe_customer_id)
-                stripe.Customer.modify(
+                customer = stripe.Customer.modify(
                     self.user.stripe_customer_id,
                     invoice_settings={"default_payment_method": pm.stripe_id},
+                    expand=CUSTOMER_EXPAND,
                 )
                 # * Try to update payment method if subscription present
                 try:
-                    self.user.app_subscription.card = pm.card.last4
+                    self.user.app_subscription.card = self.card_last4(customer)
                     self.user.app_subscription.save(update_fields=["card"])
                 except User.app_subscription.RelatedObjectDoesNotExist as e:
                     django_logger.error(e)
@@ -63,6 +153,7 @@ class StripeSubscriptionService:
             django_logger.info(f"Source of Stripe customer {self.user.stripe_customer_id} was updated")
         return self.user
 
+    @instrumented
     def create_subscription(self) -> AppSubscription:
         """Creates subscription on stripe and
         subscription object with all required data
@@ -75,6 +166,7 @@ class StripeSubscriptionService:
                 items=[
                     {"price": self.plan.price_token},
                 ],
+                expand=SUBSCRIPTION_EXPAND,
             )
         except stripe.error.InvalidRequestError as e:
             django_logger.error(e)
@@ -82,44 +174,43 @@ class StripeSubscriptionService:
         except stripe.error.AuthenticationError as e:
             django_logger.error(e)
             return
-        try:
-            customer = stripe.Customer.retrieve(resp["customer"])
-            card = customer.retrieve_payment_method(customer["invoice_settings"]["default_payment_method"])["card"]
-        except stripe.error.InvalidRequestError as e:
-            django_logger.error(e)
         subscription, _ = AppSubscription.objects.update_or_create(
             user=self.user,
             defaults={
                 "subscription_id": resp["id"],
+                "subscription_item_id": resp["items"]["data"][0]["id"],
                 "start_date": datetime.fromtimestamp(resp["start_date"]),
                 "current_period_end": datetime.fromtimestamp(resp["current_period_end"]),
                 "cancel_at_period_end": resp["cancel_at_period_end"],
                 "plan": self.plan,
                 "is_active": True,
-                "card": card.get("last4", ""),
+                "card": self.card_last4(resp),
                 "canceled_at": None,
             },
         )
         return subscription
 
-    def modify_subscription(self) -> AppSubscription:
+    @instrumented
+    def modify_subscription(self, idempotency_key: str | None = None) -> AppSubscription:
         """Modifies existed subscription on stripe and
         subscription object with all required data
 
+        :param idempotency_key: makes retries of the modification safe
         :return: user's StripeSubscription instance
         """
         try:
-            subscription = stripe.Subscription.retrieve(self.user.app_subscription.subscription_id)
             resp = stripe.Subscription.modify(
-                subscription["id"],
+                self.user.app_subscription.subscription_id,
                 cancel_at_period_end=False,
                 proration_behavior="create_prorations",
                 items=[
                     {
-                        "id": subscription["items"]["data"][0]["id"],
+                        "id": self.subscription_item_id(),
                         "price": self.plan.price_token,
                     },
                 ],
+                expand=SUBSCRIPTION_EXPAND,
+                idempotency_key=idempotency_key,
             )
         except (stripe.error.InvalidRequestError, stripe.error.AuthenticationError) as e:
             django_logger.error(e)
@@ -131,13 +222,30 @@ class StripeSubscriptionService:
                 "start_date": datetime.fromtimestamp(resp["start_date"]),
                 "current_period_end": datetime.fromtimestamp(resp["current_period_end"]),
                 "cancel_at_period_end": resp["cancel_at_period_end"],
+                "subscription_item_id": resp["items"]["data"][0]["id"],
                 "plan": self.plan,
                 "is_active": True,
+                "card": self.card_last4(resp),
                 "canceled_at": None,
             },
         )
         return subscription
 
+    @instrumented
+    def subscription_item_id(self) -> str:
+        """Returns id of the subscription item from AppSubscription kept up to date by webhooks,
+        it is retrieved from stripe only for subscriptions created before it was stored
+
+        :return: Stripe subscription item ID
+        """
+        app_subscription = self.user.app_subscription
+        if not app_subscription.subscription_item_id:
+            subscription = stripe.Subscription.retrieve(app_subscription.subscription_id)
+            app_subscription.subscription_item_id = subscription["items"]["data"][0]["id"]
+            app_subscription.save(update_fields=["subscription_item_id"])
+        return app_subscription.subscription_item_id
+
+    @instrumented
     def cancel_subscription_immediately(self) -> AppSubscription:
         """Cancel immediately current subscription on stripe
         and set inactive current user subscription.
@@ -157,6 +265,7 @@ class StripeSubscriptionService:
         self.user.app_subscription.save()
         return self.user.app_subscription
 
+    @instrumented
     def cancel_subscription_at_period_end(self) -> AppSubscription:
         """Cancel at period end current subscription on stripe
         and set inactive current user subscription
@@ -180,7 +289,50 @@ class StripeSubscriptionService:
         self.user.app_subscription.save()
         return self.user.app_subscription
 
+    @classmethod
+    def migrate_plan(cls, users, plan: AppPlan, concurrency: int = BULK_CONCURRENCY) -> list[BulkResult]:
+        """Moves subscriptions of all users to the plan using a thread pool.
+        Requests are throttled to REQUESTS_PER_SECOND and retried on Stripe rate limit errors,
+        idempotency keys make it safe to rerun the migration for the same plan
+
+        :param users: users with subscription
+        :param plan: new subscription plan
+        :param concurrency: number of users processed in parallel
+        :return: result for every user in the same order
+        """
+        limiter = RateLimiter()
+
+        def migrate(user: User) -> BulkResult:
+            try:
+                for attempt in range(RATE_LIMIT_RETRIES + 1):
+                    # * modify_subscription retrieves the subscription only if its item id is not stored
+                    limiter.wait(requests=1 if user.app_subscription.subscription_item_id else 2)
+                    try:
+                        subscription = cls(user=user, plan=plan).modify_subscription(
+                            idempotency_key=f"migrate-plan-{user.app_subscription.subscription_id}-{plan.price_token}",
+                        )
+                    except stripe.error.RateLimitError as e:
+                        if attempt == RATE_LIMIT_RETRIES:
+                            return BulkResult(user=user, error=str(e))
+                        time.sleep(random.uniform(0, 2**attempt))
+                        continue
+                    return BulkResult(
+                        user=user, subscription=subscription, error="" if subscription else "Stripe error"
+                    )
+            except Exception as e:
+                django_logger.error(e)
+                return BulkResult(user=user, error=str(e))
+            finally:
+                # * Worker threads open their own database connections
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(migrate, users))
+        django_logger.info(f"Plan migration finished: {sum(r.ok for r in results)}/{len(results)} succeeded")
+        return results
+
     @staticmethod
+    @instrumented
     def finalize_invoice(invoice_id) -> None:
         """Finalizes a draft invoice manually and attempt to pay it
 
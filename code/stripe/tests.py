@@ -0,0 +1,131 @@
+import hashlib
+import hmac
+import json
+import time
+from datetime import datetime
+from unittest import mock
+
+import stripe
+from django.test import SimpleTestCase, TestCase
+
+from .invoices import _failed_state
+from .models import StripeEvent, StripeInvoice
+from .stripe import StripeSubscriptionService
+from .webhooks import invoice_updated, process_event
+
+API_KEY = "sk_test_123"
+WEBHOOK_SECRET = "whsec_test"
+
+
+def payment_method(last4: str = "4242") -> dict:
+    return {"id": "pm_123", "object": "payment_method", "type": "card", "card": {"last4": last4}}
+
+
+def customer(default_payment_method=None) -> dict:
+    return {
+        "id": "cus_123",
+        "object": "customer",
+        "invoice_settings": {"default_payment_method": default_payment_method},
+    }
+
+
+def subscription(default_payment_method=None, customer="cus_123") -> stripe.Subscription:
+    return stripe.Subscription.construct_from(
+        {
+            "id": "sub_123",
+            "object": "subscription",
+            "customer": customer,
+            "default_payment_method": default_payment_method,
+        },
+        API_KEY,
+    )
+
+
+class CardLast4Test(SimpleTestCase):
+    """`card_last4` gets objects constructed by stripe-python, which are not dicts"""
+
+    def test_subscription_payment_method(self):
+        self.assertEqual(StripeSubscriptionService.card_last4(subscription(payment_method("1111"))), "1111")
+
+    def test_subscription_falls_back_to_customer_payment_method(self):
+        obj = subscription(customer=customer(payment_method("2222")))
+        self.assertEqual(StripeSubscriptionService.card_last4(obj), "2222")
+
+    def test_customer(self):
+        obj = stripe.Customer.construct_from(customer(payment_method("3333")), API_KEY)
+        self.assertEqual(StripeSubscriptionService.card_last4(obj), "3333")
+
+    def test_not_expanded(self):
+        self.assertEqual(StripeSubscriptionService.card_last4(subscription("pm_123")), "")
+
+    def test_without_card(self):
+        self.assertEqual(StripeSubscriptionService.card_last4(subscription()), "")
+        obj = stripe.Customer.construct_from(customer(), API_KEY)
+        self.assertEqual(StripeSubscriptionService.card_last4(obj), "")
+
+
+def construct_event(event_id: str, event_type: str, obj: dict, created: int | None = None) -> stripe.Event:
+    """Signs the event payload and verifies it like `stripe_webhook` does"""
+    created = created or int(time.time())
+    payload = json.dumps(
+        {"id": event_id, "object": "event", "type": event_type, "created": created, "data": {"object": obj}}
+    )
+    signature = hmac.new(WEBHOOK_SECRET.encode(), f"{created}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return stripe.Webhook.construct_event(payload, f"t={created},v1={signature}", WEBHOOK_SECRET)
+
+
+class ProcessEventTest(TestCase):
+    """Events go through `stripe.Webhook.construct_event`, so handlers get Stripe objects, not dicts"""
+
+    def test_payment_method_attached(self):
+        obj = payment_method() | {"customer": "cus_123"}
+        self.assertTrue(process_event(construct_event("evt_1", "payment_method.attached", obj)))
+        self.assertTrue(StripeEvent.objects.filter(pk="evt_1").exists())
+
+    def test_invoice_without_optional_fields(self):
+        obj = {"id": "in_123", "object": "invoice", "status": "open"}
+        self.assertTrue(process_event(construct_event("evt_2", "invoice.finalized", obj)))
+        self.assertTrue(StripeEvent.objects.filter(pk="evt_2").exists())
+
+    def test_redelivered_event_is_skipped(self):
+        event = construct_event("evt_3", "payment_method.attached", payment_method() | {"customer": "cus_123"})
+        self.assertTrue(process_event(event))
+        self.assertFalse(process_event(event))
+
+
+class InvoiceUpdatedTest(SimpleTestCase):
+    def test_paid_invoice_only_moves_period_forward(self):
+        invoice = stripe.Invoice.construct_from(
+            {
+                "id": "in_123",
+                "object": "invoice",
+                "status": "paid",
+                "subscription": "sub_123",
+                "lines": {"object": "list", "data": [{"period": {"end": 1700000000}}]},
+            },
+            API_KEY,
+        )
+        with mock.patch(f"{invoice_updated.__module__}.AppSubscription") as app_subscription:
+            invoice_updated(invoice)
+        (period,), lookup = app_subscription.objects.filter.call_args
+        self.assertEqual(lookup, {"subscription_id": "sub_123"})
+        self.assertIn(("current_period_end__lt", datetime.fromtimestamp(1700000000)), period.children)
+        # * Activity is set by subscription events only, a late invoice must not reactivate a canceled subscription
+        app_subscription.objects.filter.return_value.update.assert_called_once_with(
+            current_period_end=datetime.fromtimestamp(1700000000)
+        )
+
+
+class FailedStateTest(SimpleTestCase):
+    def test_finalized_invoice_is_paid_by_next_run(self):
+        error = stripe.error.CardError("Your card was declined", None, "card_declined")
+        self.assertEqual(_failed_state(StripeInvoice.State.FINALIZED, error), StripeInvoice.State.FINALIZED)
+
+    def test_transient_error_keeps_invoice_finalizing(self):
+        for error in (stripe.error.APIConnectionError("timeout"), stripe.error.RateLimitError("rate limit")):
+            self.assertEqual(_failed_state(None, error), StripeInvoice.State.FINALIZING)
+        self.assertEqual(_failed_state(None, RuntimeError("database")), StripeInvoice.State.FINALIZING)
+
+    def test_rejected_draft_fails(self):
+        error = stripe.error.InvalidRequestError("Invoice has no line items", "invoice")
+        self.assertEqual(_failed_state(StripeInvoice.State.FINALIZING, error), StripeInvoice.State.FAILED)
@@ -0,0 +1,164 @@
+import logging
+from datetime import datetime
+
+import stripe
+from app.models import AppPlan, AppSubscription
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import HttpRequest, HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from .models import StripeEvent
+
+django_logger = logging.getLogger("django")
+
+ACTIVE_STATUSES = {"active", "trialing", "past_due"}
+"statuses of Stripe subscription which keep AppSubscription active"
+
+
+def _timestamp(value: int | None) -> datetime | None:
+    return datetime.fromtimestamp(value) if value else None
+
+
+def _value(obj: stripe.StripeObject, key: str):
+    """Value of the key or None if the object doesn't have it, Stripe objects are not dicts and have no `get`"""
+    return obj[key] if key in obj else None
+
+
+def subscription_fields(subscription: stripe.Subscription) -> dict:
+    """Converts Stripe subscription into AppSubscription fields, except of the plan
+
+    :param subscription: Stripe subscription
+    :return: AppSubscription field values
+    """
+    return {
+        "subscription_item_id": subscription["items"]["data"][0]["id"],
+        "start_date": _timestamp(subscription["start_date"]),
+        "current_period_end": _timestamp(subscription["current_period_end"]),
+        "cancel_at_period_end": subscription["cancel_at_period_end"],
+        "canceled_at": _timestamp(subscription["canceled_at"]),
+        "is_active": subscription["status"] in ACTIVE_STATUSES,
+    }
+
+
+def subscription_price(subscription: stripe.Subscription) -> str:
+    """Returns price of the subscription, which is AppPlan.price_token"""
+    return subscription["items"]["data"][0]["price"]["id"]
+
+
+def subscription_updated(subscription: stripe.Subscription) -> None:
+    """Mirrors state of Stripe subscription to AppSubscription.
+    Handles customer.subscription.created/updated/deleted/paused/resumed events
+
+    :param subscription: Stripe subscription from the event
+    """
+    fields = subscription_fields(subscription)
+    if plan := AppPlan.objects.filter(price_token=subscription_price(subscription)).first():
+        fields["plan"] = plan
+    AppSubscription.objects.filter(subscription_id=subscription["id"]).update(**fields)
+
+
+def invoice_updated(invoice: stripe.Invoice) -> None:
+    """Extends period of AppSubscription when its invoice is paid. Handles invoice.* events.
+    Invoice events are ordered per invoice, not per subscription, so a late invoice only moves
+    the period forward and activity of the subscription is left to customer.subscription.* events
+
+    :param invoice: Stripe invoice from the event
+    """
+    if not _value(invoice, "subscription"):
+        return
+    if invoice["status"] == "paid":
+        period_end = _timestamp(invoice["lines"]["data"][0]["period"]["end"])
+        AppSubscription.objects.filter(
+            Q(current_period_end__isnull=True) | Q(current_period_end__lt=period_end),
+            subscription_id=invoice["subscription"],
+        ).update(current_period_end=period_end)
+    elif invoice["status"] == "open" and _value(invoice, "attempted"):
+        django_logger.warning(f"Payment of invoice {invoice['id']} for subscription {invoice['subscription']} failed")
+
+
+def payment_method_attached(payment_method: stripe.PaymentMethod) -> None:
+    """Stores last 4 digits of the attached card. Handles payment_method.attached event
+
+    :param payment_method: Stripe payment method from the event
+    """
+    if _value(payment_method, "card"):
+        AppSubscription.objects.filter(user__stripe_customer_id=payment_method["customer"]).update(
+            card=payment_method["card"]["last4"],
+        )
+
+
+def ordering_key(event: stripe.Event) -> str:
+    """Returns type and Stripe ID of the object which state is changed by the event.
+    Events of the same object are applied in order of their creation, events of different
+    object types don't outdate each other, e.g. an invoice event doesn't skip an older subscription event
+
+    :param event: Stripe event
+    :return: "subscription:<id>", "invoice:<id>" or "customer:<id>" for payment method events
+    """
+    obj = event["data"]["object"]
+    if event["type"].startswith("customer.subscription."):
+        return f"subscription:{obj['id']}"
+    if event["type"].startswith("invoice."):
+        return f"invoice:{obj['id']}"
+    return f"customer:{obj['customer']}" if _value(obj, "customer") else ""
+
+
+def process_event(event: stripe.Event) -> bool:
+    """Applies the event exactly once. Redelivered events are skipped by the primary key lookup
+    and events older than the last processed event of the same object are recorded but not applied
+
+    :param event: verified Stripe event
+    :return: whether the event was applied
+    """
+    if StripeEvent.objects.filter(pk=event["id"]).exists():
+        return False
+    object_id = ordering_key(event)
+    created = datetime.fromtimestamp(event["created"])
+    try:
+        with transaction.atomic():
+            is_outdated = object_id and StripeEvent.objects.filter(object_id=object_id, created__gt=created).exists()
+            if not is_outdated:
+                handle_event(event)
+            StripeEvent.objects.create(id=event["id"], type=event["type"], object_id=object_id, created=created)
+    except IntegrityError:
+        # * The same event is processed concurrently
+        return False
+    if is_outdated:
+        django_logger.info(f"Skipped outdated Stripe event {event['id']} for {object_id}")
+    return not is_outdated
+
+
+def handle_event(event: stripe.Event) -> None:
+    """Dispatches Stripe event to its handler, unknown events are ignored
+
+    :param event: verified Stripe event
+    """
+    event_type = event["type"]
+    if event_type.startswith("customer.subscription."):
+        subscription_updated(event["data"]["object"])
+    elif event_type.startswith("invoice."):
+        invoice_updated(event["data"]["object"])
+    elif event_type == "payment_method.attached":
+        payment_method_attached(event["data"]["object"])
+
+
+@csrf_exempt
+@require_POST
+def stripe_webhook(request: HttpRequest) -> HttpResponse:
+    """Receives Stripe webhooks and keeps AppSubscription in sync with Stripe,
+    so StripeSubscriptionService doesn't need to read subscriptions from Stripe
+    """
+    try:
+        event = stripe.Webhook.construct_event(
+            request.body,
+            request.headers.get("Stripe-Signature"),
+            settings.STRIPE_WEBHOOK_SECRET,
+        )
+    except (ValueError, stripe.error.SignatureVerificationError) as e:
+        django_logger.error(e)
+        return HttpResponse(status=400)
+    process_event(event)
+    return HttpResponse(status=200)